@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+from langdetect import detect
+
+import bot
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_langdetect_corpus.jsonl")
+
+def load_corpus(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def load_texts(db_file, json_file):
+    texts = []
+    if os.path.exists(db_file):
+        db = sqlite3.connect(db_file)
+        try:
+            texts = [row[0] for row in db.execute("SELECT content FROM memory WHERE role = 'user'")]
+        except sqlite3.Error as e:
+            print(f"Could not read {db_file}: {e}")
+        finally:
+            db.close()
+    if not texts and os.path.exists(json_file):
+        with open(json_file, 'r', encoding='utf-8') as f:
+            for history in json.load(f).values():
+                texts.extend(msg["content"] for msg in history if msg.get("role") == "user")
+    return [text for text in texts if isinstance(text, str) and text.strip()]
+
+def timed(fn, texts):
+    results = []
+    durations = []
+    for text in texts:
+        started = time.perf_counter()
+        try:
+            results.append(fn(text))
+        except Exception:
+            results.append(None)
+        durations.append(time.perf_counter() - started)
+    return results, durations
+
+def summary(name, durations):
+    ordered = sorted(durations)
+    total = sum(ordered)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    print(f"{name:<16} total {total * 1000:9.1f} ms  mean {total / len(ordered) * 1000:7.3f} ms  p95 {p95 * 1000:7.3f} ms  max {ordered[-1] * 1000:7.3f} ms")
+
+def accuracy(corpus):
+    texts = [item["text"] for item in corpus]
+    old, _ = timed(detect, texts)
+    new, _ = timed(bot.detect_language, texts)
+    groups = {}
+    for item, a, b in zip(corpus, old, new):
+        group = groups.setdefault(item["group"], [0, 0, 0])
+        group[0] += 1
+        group[1] += a == item["lang"]
+        group[2] += b == item["lang"]
+    print(f"{'labelled corpus':<16} {'texts':>5}  {'langdetect':>10}  {'detect_language':>15}")
+    for name, (total, old_ok, new_ok) in sorted(groups.items()):
+        print(f"{name:<16} {total:>5}  {old_ok / total:>10.1%}  {new_ok / total:>15.1%}")
+    total = len(corpus)
+    print(f"{'all':<16} {total:>5}  {sum(g[1] for g in groups.values()) / total:>10.1%}  {sum(g[2] for g in groups.values()) / total:>15.1%}")
+    for item, a, b in zip(corpus, old, new):
+        if b != item["lang"]:
+            print(f"  wrong: {item['lang']} -> {b}: {item['text'][:60]!r}")
+
+def main():
+    db_file = sys.argv[1] if len(sys.argv) > 1 else bot.DB_FILE
+    json_file = sys.argv[2] if len(sys.argv) > 2 else "memory.json"
+
+    started = time.perf_counter()
+    bot.warm_language_detector()
+    print(f"warm-up          {(time.perf_counter() - started) * 1000:9.1f} ms")
+
+    accuracy(load_corpus(CORPUS_FILE))
+    print()
+
+    # timing and agreement on what users actually send
+    texts = load_texts(db_file, json_file) + [item["text"] for item in load_corpus(CORPUS_FILE)]
+    print(f"{len(texts)} texts")
+    # start cold, the accuracy pass above already filled the cache
+    bot.language_cache = bot.TTLCache(maxsize=bot.LANGDETECT_CACHE_SIZE, ttl=86400)
+    old, old_times = timed(detect, texts)
+    new, new_times = timed(bot.detect_language, texts)
+    _, cached_times = timed(bot.detect_language, texts)
+
+    summary("langdetect", old_times)
+    summary("detect_language", new_times)
+    summary("cached", cached_times)
+
+    agreed = sum(1 for a, b in zip(old, new) if a == b)
+    print(f"agreement        {agreed}/{len(texts)} ({agreed / len(texts):.1%})")
+    print(f"paths            {bot.langdetect_stats}")
+    for text, a, b in zip(texts, old, new):
+        if a != b:
+            print(f"  {a} -> {b}: {text[:60]!r}")
+
+if __name__ == "__main__":
+    main()
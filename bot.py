@@ -1,26 +1,43 @@
 import os
 import json
 import logging
+import sqlite3
+import signal
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, deque
 import base64
+import contextvars
+import heapq
+import hashlib
 import re
+import unicodedata
+import random
 from io import BytesIO
-from datetime import datetime
+from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler, ContextTypes, filters
+from telegram.ext import Application, BaseUpdateProcessor, ChatMemberHandler, CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler, ContextTypes, filters
 from telegram.constants import ChatType
-from groq import Groq
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from groq import AsyncGroq, DefaultAsyncHttpxClient, APIConnectionError, APIStatusError, RateLimitError
+import httpx
 import aiohttp
 from aiohttp import web
 import asyncio
 import fitz
 from gtts import gTTS
-from langdetect import detect
+from langdetect import DetectorFactory, detect
+from PIL import Image, ImageChops
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
+GROQ_API_KEYS = [key.strip() for key in (os.environ.get("GROQ_API_KEYS") or GROQ_API_KEY or "").split(",") if key.strip()]
 REQUIRED_CHANNEL = "@TepthonHelp"
 DEVELOPER_USERNAME = "Dev_Mido"
 DEVELOPER_ID = None
@@ -30,8 +47,165 @@ MEMBER_FILE = "member.json"
 MEMORY_FILE = "memory.json"
 BANNED_FILE = "banned.json"
 SETTINGS_FILE = "settings.json"
-
-groq_client = Groq(api_key=GROQ_API_KEY)
+DB_FILE = os.environ.get("DB_FILE", "bot.db")
+MEMORY_LIMIT = 20
+MEMORY_CACHE_SIZE = int(os.environ.get("MEMORY_CACHE_SIZE", 2000))
+# history is budgeted in tokens per task; photos and PDFs bring their own context and skip it
+MEMORY_BUDGETS = {"text": 1500, "vision": 0, "pdf": 0}
+MEMORY_BUDGETS.update(json.loads(os.environ.get("MEMORY_BUDGETS") or "{}"))
+MEMORY_TURN_MAX_TOKENS = int(os.environ.get("MEMORY_TURN_MAX_TOKENS", 400))
+MEMORY_SUMMARY_TRIGGER = int(os.environ.get("MEMORY_SUMMARY_TRIGGER", 2500))
+MEMORY_KEEP_TOKENS = int(os.environ.get("MEMORY_KEEP_TOKENS", 1000))
+MEMORY_SUMMARY_TOKENS = int(os.environ.get("MEMORY_SUMMARY_TOKENS", 300))
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", 5))
+STATE_MAX_DIRTY = int(os.environ.get("STATE_MAX_DIRTY", 500))
+SHUTDOWN_TASK_TIMEOUT = float(os.environ.get("SHUTDOWN_TASK_TIMEOUT", 10))
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 10))
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get("BROADCAST_PROGRESS_INTERVAL", 5))
+BANNED_RELOAD_INTERVAL = float(os.environ.get("BANNED_RELOAD_INTERVAL", 10))
+
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", 2))
+PDF_MAX_JOBS = int(os.environ.get("PDF_MAX_JOBS", 10))
+PDF_MAX_PAGES = int(os.environ.get("PDF_MAX_PAGES", 200))
+PDF_TIMEOUT = float(os.environ.get("PDF_TIMEOUT", 30))
+PDF_MAX_CHARS = int(os.environ.get("PDF_MAX_CHARS", 5000))
+PDF_LARGE_MAX_CHARS = int(os.environ.get("PDF_LARGE_MAX_CHARS", 40000))
+PDF_CHUNK_CHARS = int(os.environ.get("PDF_CHUNK_CHARS", 4000))
+PDF_MAP_CONCURRENCY = int(os.environ.get("PDF_MAP_CONCURRENCY", 3))
+PDF_PAGE_CACHE_SIZE = int(os.environ.get("PDF_PAGE_CACHE_SIZE", 2000))
+
+SUBSCRIPTION_TTL = float(os.environ.get("SUBSCRIPTION_TTL", 600))
+SUBSCRIPTION_NEGATIVE_TTL = float(os.environ.get("SUBSCRIPTION_NEGATIVE_TTL", 15))
+SUBSCRIBED_STATUSES = ['member', 'administrator', 'creator']
+
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", 64))
+USER_MAX_PENDING_UPDATES = int(os.environ.get("USER_MAX_PENDING_UPDATES", 8))
+
+USER_MAX_SOLVES = int(os.environ.get("USER_MAX_SOLVES", 1))
+USER_SOLVES_PER_MINUTE = float(os.environ.get("USER_SOLVES_PER_MINUTE", 6))
+USER_SOLVE_BURST = int(os.environ.get("USER_SOLVE_BURST", 3))
+USER_SUPERSEDE = os.environ.get("USER_SUPERSEDE", "1") != "0"
+SUPERSEDED_TEXT = "تم الغاء هاد السؤال ❌"
+
+# core question solving outranks the VIP extras; lower priority numbers get LLM slots first
+LANE_LIMITS = {"text": 16, "vision": 8, "pdf": 3, "vip": 4}
+LANE_LIMITS.update(json.loads(os.environ.get("LANE_LIMITS") or "{}"))
+LANE_PRIORITIES = {"text": 0, "vision": 1, "pdf": 2, "vip": 3}
+BACKGROUND_PRIORITY = 4
+LANE_FEEDBACK_INTERVAL = float(os.environ.get("LANE_FEEDBACK_INTERVAL", 3))
+
+HOROSCOPE_PREGEN_TIME = os.environ.get("HOROSCOPE_PREGEN_TIME", "00:05")
+
+GAME_BATCH_SIZE = int(os.environ.get("GAME_BATCH_SIZE", 10))
+GAME_POOL_LOW = int(os.environ.get("GAME_POOL_LOW", 5))
+GAME_POOL_TARGET = int(os.environ.get("GAME_POOL_TARGET", 20))
+GAME_SERVED_KEEP = 2000
+
+TRANSLATION_CACHE_SIZE = int(os.environ.get("TRANSLATION_CACHE_SIZE", 20000))
+TRANSLATION_CACHE_TTL = float(os.environ.get("TRANSLATION_CACHE_TTL", 7 * 86400))
+TRANSLATE_MAX_TARGETS = 5
+
+LANGDETECT_SAMPLE_CHARS = int(os.environ.get("LANGDETECT_SAMPLE_CHARS", 300))
+LANGDETECT_SCRIPT_RATIO = float(os.environ.get("LANGDETECT_SCRIPT_RATIO", 0.6))
+LANGDETECT_CACHE_SIZE = int(os.environ.get("LANGDETECT_CACHE_SIZE", 20000))
+LANGDETECT_PERSIAN_RATIO = float(os.environ.get("LANGDETECT_PERSIAN_RATIO", 0.03))
+
+GAME_TYPES = {
+    "iq": "اسئلة ذكاء",
+    "riddles": "الغاز",
+    "trivia": "معلومات عامة"
+}
+GAME_LETTERS = ["a", "b", "c", "d"]
+GAME_LETTERS_AR = ["أ", "ب", "ج", "د"]
+
+LARGE_MODEL = "llama-3.3-70b-versatile"
+SMALL_MODEL = "llama-3.1-8b-instant"
+VISION_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+VISION_FALLBACK_MODEL = "meta-llama/llama-4-maverick-17b-128e-instruct"
+
+# each task tries its models in order, falling back on timeouts, rate limits and server errors
+MODEL_ROUTES = {
+    "text": [LARGE_MODEL, SMALL_MODEL],
+    "vision": [VISION_MODEL, VISION_FALLBACK_MODEL],
+    "pdf": [LARGE_MODEL, SMALL_MODEL],
+    "translate": [SMALL_MODEL, LARGE_MODEL],
+    "game": [SMALL_MODEL, LARGE_MODEL],
+    "horoscope": [SMALL_MODEL, LARGE_MODEL],
+    "story": [LARGE_MODEL, SMALL_MODEL],
+    "summary": [SMALL_MODEL, LARGE_MODEL]
+}
+MODEL_ROUTES.update(json.loads(os.environ.get("MODEL_ROUTES") or "{}"))
+MODEL_RACE_TASKS = {task.strip() for task in os.environ.get("MODEL_RACE_TASKS", "").split(",") if task.strip()}
+
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 5000))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 86400))
+PHASH_MAX_DISTANCE = int(os.environ.get("PHASH_MAX_DISTANCE", 10))
+PHASH_INDEX_SIZE = int(os.environ.get("PHASH_INDEX_SIZE", 5000))
+
+PHOTO_MIN_SIDE = int(os.environ.get("PHOTO_MIN_SIDE", 720))
+PHOTO_MAX_SIDE = int(os.environ.get("PHOTO_MAX_SIDE", 1600))
+PHOTO_TARGET_BYTES = int(os.environ.get("PHOTO_TARGET_BYTES", 300000))
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))
+
+TTS_WORKERS = int(os.environ.get("TTS_WORKERS", 4))
+TTS_CHUNK_CHARS = int(os.environ.get("TTS_CHUNK_CHARS", 500))
+TTS_MAX_CHARS = int(os.environ.get("TTS_MAX_CHARS", 5000))
+TTS_TIMEOUT = float(os.environ.get("TTS_TIMEOUT", 60))
+TTS_LANGS = ['ar', 'en', 'fr', 'es', 'de', 'it', 'ru', 'pt', 'tr', 'hi', 'ja', 'ko', 'zh-cn']
+
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 60))
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 50))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", 120))
+LLM_MAX_IN_FLIGHT = int(os.environ.get("LLM_MAX_IN_FLIGHT", 32))
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 5))
+BREAKER_BASE_DELAY = float(os.environ.get("BREAKER_BASE_DELAY", 10))
+BREAKER_MAX_DELAY = float(os.environ.get("BREAKER_MAX_DELAY", 300))
+
+STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "1") != "0"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.5))
+MESSAGE_PAGE_CHARS = 4000
+
+llm_http_client = None
+llm_clients = []
+llm_pools = {}
+llm_breakers = {}
+current_lane = contextvars.ContextVar("current_lane", default=None)
+llm_key_released = asyncio.Event()
+llm_stats = {"queued": 0, "fallbacks": 0, "races": 0}
+db = None
+db_lock = threading.Lock()
+
+members = {}
+settings = {}
+banned = set()
+memories = OrderedDict()
+dirty_members = set()
+dirty_settings = set()
+dirty_memory = set()
+dirty_banned = set()
+flush_lock = asyncio.Lock()
+flush_task = None
+banned_file_mtime = None
+# the ban list as last written to (or read from) the file, so a hot reload applies only what was edited there
+exported_banned = set()
+state_stats = {"flushes": 0, "bytes_written": 0, "records_written": 0}
+
+pdf_executor = None
+pdf_semaphore = asyncio.Semaphore(PDF_WORKERS)
+solve_tasks = {}
+broadcast_tasks = set()
+horoscopes = {}
+horoscope_tasks = {}
+horoscope_stats = {"hits": 0, "misses": 0, "generated": 0}
+game_pools = {game_type: deque() for game_type in GAME_TYPES}
+game_refills = {}
+game_ready = {}
+game_stats = {"served": 0, "misses": 0, "generated": 0, "rejected": 0, "duplicates": 0}
+summary_tasks = {}
+memory_stats = {"summaries": 0, "summarized_turns": 0, "skipped": 0, "clipped": 0, "errors": 0}
+admission_stats = {"rate_limited": 0, "superseded": 0, "rejected": 0, "updates_dropped": 0}
+pdf_stats = {"queued": 0, "running": 0, "completed": 0, "timeouts": 0, "cancelled": 0, "rejected": 0, "pages_extracted": 0, "pool_restarts": 0}
 
 PERSONALITIES = {
     "teacher": {"name": "معلم 🕵🏻", "prompt": "انت معلم خبير ومتخصص. تشرح الامور بطريقة تعليمية واكاديمية مفصلة مع امثلة توضيحية."},
@@ -55,6 +229,57 @@ ZODIAC_SIGNS = {
     "sagittarius": "القوس ♐", "capricorn": "الجدي ♑", "aquarius": "الدلو ♒", "pisces": "الحوت ♓"
 }
 
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+    
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+    
+    def set(self, key, value, ttl=None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key):
+        self._data.pop(key, None)
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+subscription_cache = TTLCache(maxsize=100000, ttl=SUBSCRIPTION_TTL)
+pdf_page_cache = TTLCache(maxsize=PDF_PAGE_CACHE_SIZE, ttl=3600)
+answer_cache = TTLCache(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+user_buckets = TTLCache(maxsize=100000, ttl=3600)
+translation_cache = TTLCache(maxsize=TRANSLATION_CACHE_SIZE, ttl=TRANSLATION_CACHE_TTL)
+language_cache = TTLCache(maxsize=LANGDETECT_CACHE_SIZE, ttl=86400)
+langdetect_stats = {"script": 0, "langdetect": 0, "failed": 0}
+phash_index = deque(maxlen=PHASH_INDEX_SIZE)
+phash_stats = {"hits": 0, "misses": 0, "errors": 0}
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+image_stats = {"processed": 0, "bytes_in": 0, "bytes_out": 0}
+tts_executor = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+tts_stats = {"cache_hits": 0, "synthesized": 0, "chunks": 0, "stale_file_ids": 0}
+
 def load_json(filename):
     try:
         if os.path.exists(filename):
@@ -64,99 +289,1501 @@ def load_json(filename):
         pass
     return {}
 
-def save_json(filename, data):
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def init_db():
+    global db
+    db = sqlite3.connect(DB_FILE, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS members (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            joined TEXT,
+            last_active TEXT,
+            questions_count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS memory (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_memory_user ON memory (user_id, id);
+        CREATE TABLE IF NOT EXISTS settings (
+            user_id INTEGER PRIMARY KEY,
+            personality TEXT
+        );
+        CREATE TABLE IF NOT EXISTS banned (
+            user_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            cursor INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            success INTEGER NOT NULL DEFAULT 0,
+            fail INTEGER NOT NULL DEFAULT 0,
+            pruned INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'running'
+        );
+        CREATE TABLE IF NOT EXISTS game_questions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            game_type TEXT NOT NULL,
+            fingerprint TEXT NOT NULL UNIQUE,
+            question TEXT NOT NULL,
+            options TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            served INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_game_pool ON game_questions (game_type, served, id);
+        CREATE TABLE IF NOT EXISTS tts_cache (
+            text_hash TEXT NOT NULL,
+            lang TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            PRIMARY KEY (text_hash, lang)
+        );
+        CREATE TABLE IF NOT EXISTS horoscopes (
+            day TEXT NOT NULL,
+            sign TEXT NOT NULL,
+            text TEXT NOT NULL,
+            PRIMARY KEY (day, sign)
+        );
+    """)
+    migrate_json_files()
+    load_state()
+    load_game_pools()
+
+def migrate_json_files():
+    if db.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+        return
+    
+    members = load_json(MEMBER_FILE)
+    memory = load_json(MEMORY_FILE)
+    settings = load_json(SETTINGS_FILE)
+    banned = load_json(BANNED_FILE)
+    if not isinstance(banned, list):
+        banned = []
+    
+    with db:
+        db.executemany(
+            "INSERT OR IGNORE INTO members (user_id, username, first_name, joined, last_active, questions_count) VALUES (?, ?, ?, ?, ?, ?)",
+            [(int(user_key), m.get("username"), m.get("first_name"), m.get("joined"), m.get("last_active"), m.get("questions_count", 0))
+             for user_key, m in members.items()]
+        )
+        for user_key, turns in memory.items():
+            db.executemany(
+                "INSERT INTO memory (user_id, role, content) VALUES (?, ?, ?)",
+                [(int(user_key), t["role"], t["content"]) for t in turns[-MEMORY_LIMIT:]]
+            )
+        db.executemany(
+            "INSERT OR IGNORE INTO settings (user_id, personality) VALUES (?, ?)",
+            [(int(user_key), s.get("personality")) for user_key, s in settings.items()]
+        )
+        db.executemany("INSERT OR IGNORE INTO banned (user_id) VALUES (?)", [(int(b),) for b in banned])
+        db.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (datetime.now().isoformat(),))
+    
+    logger.info(f"Migrated JSON files to {DB_FILE}: {len(members)} members, {len(memory)} memories, {len(banned)} banned")
+
+def load_state():
+    global banned_file_mtime
+    with db_lock:
+        member_rows = db.execute("SELECT * FROM members").fetchall()
+        settings_rows = db.execute("SELECT user_id, personality FROM settings").fetchall()
+        banned_rows = db.execute("SELECT user_id FROM banned").fetchall()
+        mtime_row = db.execute("SELECT value FROM meta WHERE key = 'banned_file_mtime'").fetchone()
+    
+    banned_file_mtime = int(mtime_row["value"]) if mtime_row else None
+    for row in member_rows:
+        members[row["user_id"]] = {
+            "username": row["username"],
+            "first_name": row["first_name"],
+            "joined": row["joined"],
+            "last_active": row["last_active"],
+            "questions_count": row["questions_count"]
+        }
+    for row in settings_rows:
+        settings[row["user_id"]] = row["personality"]
+    banned.update(row["user_id"] for row in banned_rows)
+    exported_banned.update(banned)
+    logger.info(f"Loaded state: {len(members)} members, {len(settings)} settings, {len(banned)} banned")
+
+def mark_dirty(dirty, user_id):
+    global flush_task
+    dirty.add(user_id)
+    if count_dirty() >= STATE_MAX_DIRTY and (flush_task is None or flush_task.done()):
+        flush_task = asyncio.get_running_loop().create_task(flush_state())
+
+def count_dirty():
+    return len(dirty_members) + len(dirty_settings) + len(dirty_memory) + len(dirty_banned)
+
+def collect_dirty():
+    batch = {
+        "members": [
+            (user_id, members[user_id]["username"], members[user_id]["first_name"], members[user_id]["joined"],
+             members[user_id]["last_active"], members[user_id]["questions_count"])
+            for user_id in dirty_members if user_id in members
+        ],
+        "settings": [(user_id, settings[user_id]) for user_id in dirty_settings if user_id in settings],
+        "memory": {user_id: list(memories[user_id]) for user_id in dirty_memory if user_id in memories},
+        "removed_members": [user_id for user_id in dirty_members if user_id not in members],
+        "banned": [(user_id, user_id in banned) for user_id in dirty_banned]
+    }
+    dirty_members.clear()
+    dirty_settings.clear()
+    dirty_memory.clear()
+    dirty_banned.clear()
+    return batch
+
+def write_batch(batch):
+    written = 0
+    with db_lock, db:
+        db.executemany(
+            """INSERT INTO members (user_id, username, first_name, joined, last_active, questions_count) VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name,
+               last_active = excluded.last_active, questions_count = excluded.questions_count""",
+            batch["members"]
+        )
+        db.executemany(
+            "INSERT INTO settings (user_id, personality) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET personality = excluded.personality",
+            batch["settings"]
+        )
+        for user_id, turns in batch["memory"].items():
+            db.execute("DELETE FROM memory WHERE user_id = ?", (user_id,))
+            db.executemany(
+                "INSERT INTO memory (user_id, role, content) VALUES (?, ?, ?)",
+                [(user_id, t["role"], t["content"]) for t in turns]
+            )
+            written += sum(len(t["content"].encode('utf-8')) for t in turns)
+        for user_id in batch["removed_members"]:
+            db.execute("DELETE FROM members WHERE user_id = ?", (user_id,))
+            db.execute("DELETE FROM settings WHERE user_id = ?", (user_id,))
+            db.execute("DELETE FROM memory WHERE user_id = ?", (user_id,))
+        for user_id, is_banned_now in batch["banned"]:
+            if is_banned_now:
+                db.execute("INSERT OR IGNORE INTO banned (user_id) VALUES (?)", (user_id,))
+            else:
+                db.execute("DELETE FROM banned WHERE user_id = ?", (user_id,))
+    
+    for row in batch["members"] + batch["settings"]:
+        written += sum(len(str(v).encode('utf-8')) for v in row)
+    return written
 
-def load_members():
-    return load_json(MEMBER_FILE)
+async def flush_state():
+    async with flush_lock:
+        if not count_dirty():
+            return
+        batch = collect_dirty()
+        try:
+            written = await asyncio.to_thread(write_batch, batch)
+        except Exception as e:
+            logger.error(f"Error flushing state: {e}")
+            dirty_members.update(row[0] for row in batch["members"])
+            dirty_members.update(batch["removed_members"])
+            dirty_settings.update(row[0] for row in batch["settings"])
+            dirty_memory.update(batch["memory"].keys())
+            dirty_banned.update(row[0] for row in batch["banned"])
+            return
+        state_stats["flushes"] += 1
+        state_stats["bytes_written"] += written
+        state_stats["records_written"] += (
+            len(batch["members"]) + len(batch["removed_members"]) + len(batch["settings"]) + len(batch["memory"]) + len(batch["banned"])
+        )
+        trim_memory_cache()
+        if batch["banned"]:
+            await export_banned()
 
-def save_members(data):
-    save_json(MEMBER_FILE, data)
+async def export_banned():
+    global banned_file_mtime
+    ids = sorted(banned)
+    try:
+        banned_file_mtime = await asyncio.to_thread(write_banned_file, ids)
+    except Exception as e:
+        logger.error(f"Error exporting {BANNED_FILE}: {e}")
+        return
+    exported_banned.clear()
+    exported_banned.update(ids)
+
+def write_banned_file(ids):
+    tmp_file = f"{BANNED_FILE}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(ids, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, BANNED_FILE)
+    mtime = os.stat(BANNED_FILE).st_mtime_ns
+    with db_lock, db:
+        db.execute(
+            "INSERT INTO meta (key, value) VALUES ('banned_file_mtime', ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (str(mtime),)
+        )
+    return mtime
 
-def load_memory():
-    return load_json(MEMORY_FILE)
+async def reload_banned():
+    global banned_file_mtime
+    try:
+        mtime = os.stat(BANNED_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return
+    if mtime == banned_file_mtime:
+        return
+    
+    async with flush_lock:
+        data = await asyncio.to_thread(load_json, BANNED_FILE)
+        banned_file_mtime = mtime
+        try:
+            new_banned = {int(b) for b in data} if isinstance(data, list) else None
+        except (TypeError, ValueError):
+            new_banned = None
+        if new_banned is None:
+            logger.error(f"Ignoring {BANNED_FILE}: expected a list of user ids")
+            return
+        
+        # bans from the panel that are not exported yet stay; only the edits made in the file are applied
+        added = new_banned - exported_banned
+        removed = exported_banned - new_banned
+        changed = added | removed
+        banned.update(added)
+        banned.difference_update(removed)
+        dirty_banned.update(changed)
+        exported_banned.clear()
+        exported_banned.update(new_banned)
+    
+    if changed:
+        logger.info(f"Reloaded {BANNED_FILE}: {len(banned)} banned ({len(changed)} changed)")
+
+async def reload_banned_job(context: ContextTypes.DEFAULT_TYPE):
+    await reload_banned()
+
+async def flush_state_job(context: ContextTypes.DEFAULT_TYPE):
+    await flush_state()
+
+def trim_memory_cache():
+    excess = len(memories) - MEMORY_CACHE_SIZE
+    if excess <= 0:
+        return
+    for user_id in [u for u in memories if u not in dirty_memory][:excess]:
+        del memories[user_id]
 
-def save_memory(data):
-    save_json(MEMORY_FILE, data)
+def get_member_stats():
+    return len(members), sum(m.get("questions_count", 0) for m in members.values())
 
 def load_banned():
-    data = load_json(BANNED_FILE)
-    if isinstance(data, list):
-        return data
-    return []
-
-def save_banned(data):
-    save_json(BANNED_FILE, data)
-
-def load_settings():
-    return load_json(SETTINGS_FILE)
-
-def save_settings(data):
-    save_json(SETTINGS_FILE, data)
+    return sorted(banned)
 
 def get_user_personality(user_id):
-    settings = load_settings()
-    return settings.get(str(user_id), {}).get("personality", None)
+    return settings.get(user_id)
 
 def set_user_personality(user_id, personality):
-    settings = load_settings()
-    if str(user_id) not in settings:
-        settings[str(user_id)] = {}
-    settings[str(user_id)]["personality"] = personality
-    save_settings(settings)
+    settings[user_id] = personality
+    mark_dirty(dirty_settings, user_id)
 
 def add_member(user_id, username, first_name):
-    members = load_members()
-    user_key = str(user_id)
-    is_new = user_key not in members
-    members[user_key] = {
-        "username": username,
-        "first_name": first_name,
-        "joined": members.get(user_key, {}).get("joined", datetime.now().isoformat()),
-        "last_active": datetime.now().isoformat(),
-        "questions_count": members.get(user_key, {}).get("questions_count", 0)
-    }
-    save_members(members)
+    now = datetime.now().isoformat()
+    member = members.get(user_id)
+    is_new = member is None
+    if is_new:
+        member = members[user_id] = {"joined": now, "questions_count": 0}
+    member["username"] = username
+    member["first_name"] = first_name
+    member["last_active"] = now
+    mark_dirty(dirty_members, user_id)
     return is_new
 
+def remove_member(user_id):
+    members.pop(user_id, None)
+    settings.pop(user_id, None)
+    memories.pop(user_id, None)
+    mark_dirty(dirty_members, user_id)
+
 def increment_questions(user_id):
-    members = load_members()
-    user_key = str(user_id)
-    if user_key in members:
-        members[user_key]["questions_count"] = members[user_key].get("questions_count", 0) + 1
-        save_members(members)
-
-def get_user_memory(user_id):
-    memory = load_memory()
-    user_key = str(user_id)
-    return memory.get(user_key, [])
-
-def add_to_memory(user_id, role, content):
-    memory = load_memory()
-    user_key = str(user_id)
-    if user_key not in memory:
-        memory[user_key] = []
-    memory[user_key].append({"role": role, "content": content})
-    if len(memory[user_key]) > 20:
-        memory[user_key] = memory[user_key][-20:]
-    save_memory(memory)
+    member = members.get(user_id)
+    if member:
+        member["questions_count"] = member.get("questions_count", 0) + 1
+        mark_dirty(dirty_members, user_id)
+
+def load_user_memory(user_id):
+    with db_lock:
+        rows = db.execute("SELECT role, content FROM memory WHERE user_id = ? ORDER BY id", (user_id,)).fetchall()
+    return [{"role": row["role"], "content": row["content"]} for row in rows]
+
+async def get_user_memory(user_id):
+    if user_id not in memories:
+        # db_lock is held by the flush thread for whole batches, so misses read off the event loop
+        turns = await asyncio.to_thread(load_user_memory, user_id)
+        if user_id not in memories:
+            memories[user_id] = turns
+            trim_memory_cache()
+    memories.move_to_end(user_id)
+    return list(memories[user_id])
+
+def split_summary(turns):
+    # the rolling summary is stored as a leading system turn so it persists with the rest of the memory
+    if turns and turns[0]["role"] == "system":
+        return turns[:1], turns[1:]
+    return [], turns
+
+async def add_to_memory(user_id, role, content):
+    summary, turns = split_summary(await get_user_memory(user_id))
+    turns.append({"role": role, "content": content})
+    memories[user_id] = summary + turns[-MEMORY_LIMIT:]
+    memories.move_to_end(user_id)
+    mark_dirty(dirty_memory, user_id)
+    if sum(turn_tokens(turn) for turn in turns[-MEMORY_LIMIT:]) > MEMORY_SUMMARY_TRIGGER:
+        schedule_memory_summary(user_id)
+
+def turn_tokens(turn):
+    return estimate_tokens([turn], 0) + 4
+
+def clip_turn(turn):
+    if turn_tokens(turn) <= MEMORY_TURN_MAX_TOKENS:
+        return turn
+    return {"role": turn["role"], "content": turn["content"][:MEMORY_TURN_MAX_TOKENS * 3] + "..."}
+
+async def build_history(user_id, task):
+    budget = MEMORY_BUDGETS.get(task, 0)
+    if budget <= 0:
+        memory_stats["skipped"] += 1
+        return []
+    summary, turns = split_summary(await get_user_memory(user_id))
+    if summary:
+        budget -= turn_tokens(summary[0])
+    history = []
+    for turn in reversed(turns):
+        clipped = clip_turn(turn)
+        cost = turn_tokens(clipped)
+        if cost > budget:
+            break
+        if clipped is not turn:
+            memory_stats["clipped"] += 1
+        budget -= cost
+        history.append(clipped)
+    history.reverse()
+    return summary + history
+
+def schedule_memory_summary(user_id):
+    task = summary_tasks.get(user_id)
+    if task is None or task.done():
+        summary_tasks[user_id] = asyncio.ensure_future(summarize_memory(user_id))
+
+async def summarize_memory(user_id):
+    # the task inherits the solve's lane; drop it so summaries queue behind user-facing calls
+    current_lane.set(None)
+    try:
+        summary, turns = split_summary(await get_user_memory(user_id))
+        keep = 0
+        kept_tokens = 0
+        for turn in reversed(turns):
+            kept_tokens += turn_tokens(turn)
+            if keep >= 2 and kept_tokens > MEMORY_KEEP_TOKENS:
+                break
+            keep += 1
+        old = turns[:len(turns) - keep]
+        if not old:
+            return
+        
+        transcript = "\n\n".join(
+            f"{'الطالب' if turn['role'] == 'user' else 'المساعد'}: {clip_turn(turn)['content']}" for turn in old
+        )
+        if summary:
+            transcript = f"{summary[0]['content']}\n\n{transcript}"
+        messages = [
+            {"role": "system", "content": "لخص المحادثة التالية بين طالب ومساعد في فقرة قصيرة بالعربي. احتفظ بالمواضيع والاسئلة المهمة وأي معلومات عن الطالب. اكتب الملخص فقط بدون اي تنسيق."},
+            {"role": "user", "content": transcript}
+        ]
+        text = clean_markdown(await llm_route("summary", messages, MEMORY_SUMMARY_TOKENS)).strip()
+        if not text:
+            return
+        
+        current = memories.get(user_id)
+        summarized = {id(turn) for turn in old}
+        if current is None or not any(id(turn) in summarized for turn in current):
+            return
+        remaining = [turn for turn in split_summary(current)[1] if id(turn) not in summarized]
+        memories[user_id] = [{"role": "system", "content": f"ملخص المحادثة السابقة: {text}"}] + remaining
+        mark_dirty(dirty_memory, user_id)
+        memory_stats["summaries"] += 1
+        memory_stats["summarized_turns"] += len(split_summary(current)[1]) - len(remaining)
+    except Exception as e:
+        memory_stats["errors"] += 1
+        logger.error(f"Error summarizing memory for {user_id}: {e}")
+    finally:
+        summary_tasks.pop(user_id, None)
 
 def is_banned(user_id):
-    banned = load_banned()
     return user_id in banned
 
 def ban_user(user_id):
-    banned = load_banned()
-    if user_id not in banned:
-        banned.append(user_id)
-        save_banned(banned)
+    banned.add(user_id)
+    mark_dirty(dirty_banned, user_id)
 
 def unban_user(user_id):
-    banned = load_banned()
-    if user_id in banned:
-        banned.remove(user_id)
-        save_banned(banned)
+    banned.discard(user_id)
+    mark_dirty(dirty_banned, user_id)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+    
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def try_acquire(self):
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+    
+    def wait_time(self):
+        return max((1 - self._tokens) / self.rate, self._paused_until - time.monotonic(), 0)
+    
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+broadcast_bucket = TokenBucket(rate=BROADCAST_RATE, capacity=BROADCAST_RATE)
+
+class PrioritySemaphore:
+    def __init__(self, value):
+        self._value = value
+        self._waiters = []
+        self._counter = 0
+    
+    def waiting(self):
+        return sum(1 for _, _, waiter in self._waiters if not waiter.done())
+    
+    async def acquire(self, priority):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, self._counter, waiter))
+        self._counter += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+    
+    def release(self):
+        # cancelled waiters stay in the heap and are skipped here
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._value += 1
+    
+    async def __aenter__(self):
+        lane = current_lane.get()
+        await self.acquire(lane.priority if lane else BACKGROUND_PRIORITY)
+    
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+class WorkLane:
+    def __init__(self, name, limit, priority):
+        self.name = name
+        self.limit = limit
+        self.priority = priority
+        self.running = 0
+        self.waiters = deque()
+        self.stats = {"served": 0, "queued": 0, "max_wait": 0.0}
+    
+    async def acquire(self, message=None, busy_text=None, reply_markup=None):
+        if self.running < self.limit and not self.waiters:
+            self.running += 1
+            self.stats["served"] += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.stats["queued"] += 1
+        started = time.monotonic()
+        shown = None
+        try:
+            while not waiter.done():
+                position = self.waiters.index(waiter) + 1
+                if message is not None and position != shown:
+                    shown = position
+                    await edit_quietly(message, f"في ضغط هلق، انت رقم {position} بالدور ⏳", reply_markup)
+                await asyncio.wait([waiter], timeout=LANE_FEEDBACK_INTERVAL)
+            if shown is not None and busy_text:
+                await edit_quietly(message, busy_text, reply_markup)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self.waiters.remove(waiter)
+            raise
+        self.stats["served"] += 1
+        self.stats["max_wait"] = max(self.stats["max_wait"], round(time.monotonic() - started, 1))
+    
+    def release(self):
+        # a freed slot goes straight to the next waiter so running never dips below the queue
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
+    
+    def slot(self, message=None, busy_text=None, reply_markup=None):
+        return LaneSlot(self, message, busy_text, reply_markup)
+
+class LaneSlot:
+    def __init__(self, lane, message, busy_text, reply_markup):
+        self.lane = lane
+        self.message = message
+        self.busy_text = busy_text
+        self.reply_markup = reply_markup
+        self.token = None
+    
+    async def __aenter__(self):
+        await self.lane.acquire(self.message, self.busy_text, self.reply_markup)
+        self.token = current_lane.set(self.lane)
+    
+    async def __aexit__(self, *exc_info):
+        current_lane.reset(self.token)
+        self.lane.release()
+
+async def edit_quietly(message, text, reply_markup=None):
+    try:
+        await message.edit_text(text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Error updating queue position: {e}")
+
+llm_semaphore = PrioritySemaphore(LLM_MAX_IN_FLIGHT)
+work_lanes = {name: WorkLane(name, limit, LANE_PRIORITIES[name]) for name, limit in LANE_LIMITS.items()}
+
+def insert_broadcast(broadcast):
+    with db_lock, db:
+        cursor = db.execute(
+            "INSERT INTO broadcasts (text, chat_id, message_id, total) VALUES (?, ?, ?, ?)",
+            (broadcast["text"], broadcast["chat_id"], broadcast["message_id"], broadcast["total"])
+        )
+    return cursor.lastrowid
+
+def save_broadcast(broadcast):
+    with db_lock, db:
+        db.execute(
+            "UPDATE broadcasts SET cursor = ?, success = ?, fail = ?, pruned = ?, status = ? WHERE id = ?",
+            (broadcast["cursor"], broadcast["success"], broadcast["fail"], broadcast["pruned"], broadcast["status"], broadcast["id"])
+        )
+
+def load_running_broadcasts():
+    with db_lock:
+        rows = db.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id").fetchall()
+    return [dict(row) for row in rows]
+
+async def broadcast_send(bot, chat_id, text):
+    for attempt in range(3):
+        await broadcast_bucket.acquire()
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+            return "success"
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            logger.warning(f"Broadcast hit flood limit, pausing {retry_after}s")
+            broadcast_bucket.pause(retry_after)
+        except Forbidden:
+            return "pruned"
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                return "pruned"
+            return "fail"
+        except NetworkError as e:
+            logger.warning(f"Broadcast network error for {chat_id}: {e}")
+            await asyncio.sleep(2 ** attempt)
+        except Exception as e:
+            logger.error(f"Broadcast error for {chat_id}: {e}")
+            return "fail"
+    return "fail"
+
+def format_broadcast_status(broadcast):
+    done = broadcast["success"] + broadcast["fail"] + broadcast["pruned"]
+    title = "تم الاذاعة" if broadcast["status"] == "done" else f"جاري الاذاعة... {done}/{broadcast['total']}"
+    return f"{title}\n\nنجح: {broadcast['success']}\nفشل: {broadcast['fail']}\nانحذفوا (حاظرين البوت): {broadcast['pruned']}"
+
+async def report_broadcast(bot, broadcast):
+    try:
+        await bot.edit_message_text(
+            chat_id=broadcast["chat_id"],
+            message_id=broadcast["message_id"],
+            text=format_broadcast_status(broadcast)
+        )
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            logger.warning(f"Error updating broadcast status: {e}")
+    except Exception as e:
+        logger.warning(f"Error updating broadcast status: {e}")
+
+async def run_broadcast(bot, broadcast):
+    recipients = sorted(user_id for user_id in members if user_id > broadcast["cursor"])
+    last_report = time.monotonic()
+    try:
+        for i in range(0, len(recipients), BROADCAST_CONCURRENCY):
+            chunk = recipients[i:i + BROADCAST_CONCURRENCY]
+            results = await asyncio.gather(*(broadcast_send(bot, user_id, broadcast["text"]) for user_id in chunk))
+            for user_id, result in zip(chunk, results):
+                broadcast[result] += 1
+                if result == "pruned":
+                    remove_member(user_id)
+            broadcast["cursor"] = chunk[-1]
+            await asyncio.to_thread(save_broadcast, broadcast)
+            
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                await report_broadcast(bot, broadcast)
+        
+        broadcast["status"] = "done"
+        await asyncio.to_thread(save_broadcast, broadcast)
+        await report_broadcast(bot, broadcast)
+        logger.info(f"Broadcast {broadcast['id']} finished: {broadcast['success']} sent, {broadcast['fail']} failed, {broadcast['pruned']} pruned")
+    except asyncio.CancelledError:
+        # shutting down: keep the cursor of the last finished chunk so the next start resumes from there
+        await asyncio.to_thread(save_broadcast, broadcast)
+        logger.info(f"Broadcast {broadcast['id']} paused after user {broadcast['cursor']}")
+        raise
+    except Exception as e:
+        logger.error(f"Broadcast {broadcast['id']} stopped: {e}")
+
+def spawn_broadcast(bot, broadcast):
+    # not Application.create_task: app.stop() would wait for every recipient before shutting down
+    task = asyncio.create_task(run_broadcast(bot, broadcast))
+    broadcast_tasks.add(task)
+    task.add_done_callback(broadcast_tasks.discard)
+
+async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, text):
+    status_msg = await update.message.reply_text("جاري الاذاعة...")
+    broadcast = {
+        "text": text,
+        "chat_id": status_msg.chat_id,
+        "message_id": status_msg.message_id,
+        "cursor": 0,
+        "total": len(members),
+        "success": 0,
+        "fail": 0,
+        "pruned": 0,
+        "status": "running"
+    }
+    broadcast["id"] = await asyncio.to_thread(insert_broadcast, broadcast)
+    spawn_broadcast(context.bot, broadcast)
+
+def collect_metrics():
+    return {
+        "state": dict(state_stats, dirty=count_dirty(), cached_memories=len(memories)),
+        "memory": dict(memory_stats, summarizing=len(summary_tasks)),
+        "subscription_cache": subscription_cache.stats(),
+        "pdf": dict(pdf_stats, page_cache=pdf_page_cache.stats()),
+        "answer_cache": answer_cache.stats(),
+        "translation_cache": translation_cache.stats(),
+        "language_cache": language_cache.stats(),
+        "langdetect": dict(langdetect_stats),
+        "photo_similarity": dict(phash_stats, size=len(phash_index)),
+        "images": dict(image_stats),
+        "tts": dict(tts_stats),
+        "horoscopes": dict(horoscope_stats, cached=len(horoscopes)),
+        "games": dict(game_stats, pools={game_type: len(pool) for game_type, pool in game_pools.items()}),
+        "admission": dict(admission_stats, users_solving=len(solve_tasks)),
+        "lanes": {
+            name: dict(lane.stats, limit=lane.limit, running=lane.running, waiting=len(lane.waiters))
+            for name, lane in work_lanes.items()
+        },
+        "llm": dict(llm_stats, waiting=llm_semaphore.waiting(), models={model: [key.stats() for key in pool["keys"]] for model, pool in llm_pools.items()})
+    }
+
+class LLMKey:
+    def __init__(self, index, client):
+        self.index = index
+        self.client = client
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.requests_reset_at = 0.0
+        self.tokens_reset_at = 0.0
+        self.blocked_until = 0.0
+        self.in_flight = 0
+        self.reserved_tokens = 0
+        self.calls = 0
+        self.rate_limited = 0
+    
+    def headroom(self, now):
+        # budgets are only trusted until their reset time, after that the key counts as fresh
+        if now < self.blocked_until:
+            return None
+        if self.remaining_requests is not None and now < self.requests_reset_at:
+            if self.remaining_requests - self.in_flight <= 0:
+                return None
+        if self.remaining_tokens is None or now >= self.tokens_reset_at:
+            return float("inf")
+        return self.remaining_tokens - self.reserved_tokens
+    
+    def next_change(self, now):
+        times = [t for t in (self.blocked_until, self.requests_reset_at, self.tokens_reset_at) if t > now]
+        return min(times) if times else now + 1
+    
+    def update(self, headers):
+        now = time.monotonic()
+        if headers.get("x-ratelimit-remaining-requests") is not None:
+            self.remaining_requests = int(headers["x-ratelimit-remaining-requests"])
+            self.requests_reset_at = now + parse_reset_duration(headers.get("x-ratelimit-reset-requests"))
+        if headers.get("x-ratelimit-remaining-tokens") is not None:
+            self.remaining_tokens = int(headers["x-ratelimit-remaining-tokens"])
+            self.tokens_reset_at = now + parse_reset_duration(headers.get("x-ratelimit-reset-tokens"))
+    
+    def block(self, headers):
+        self.rate_limited += 1
+        try:
+            retry_after = float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            retry_after = max(parse_reset_duration(headers.get("x-ratelimit-reset-tokens")), 1)
+        self.blocked_until = time.monotonic() + retry_after
+        self.update(headers)
+    
+    def stats(self):
+        now = time.monotonic()
+        headroom = self.headroom(now)
+        return {
+            "key": self.index,
+            "remaining_requests": self.remaining_requests if now < self.requests_reset_at else None,
+            "remaining_tokens": self.remaining_tokens if now < self.tokens_reset_at else None,
+            "blocked_for": round(max(self.blocked_until - now, 0), 1),
+            "available": headroom is not None and headroom > 0,
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "rate_limited": self.rate_limited
+        }
+
+def parse_reset_duration(value):
+    # groq sends resets like "7.66s", "2m59.56s" or "120ms"
+    if not value:
+        return 0.0
+    seconds = 0.0
+    for amount, unit in re.findall(r'([\d.]+)(ms|h|m|s)', value):
+        seconds += float(amount) * {"ms": 0.001, "h": 3600, "m": 60, "s": 1}[unit]
+    return seconds
+
+def estimate_tokens(messages, max_tokens):
+    chars = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            chars += len(content)
+        else:
+            chars += sum(len(part.get("text", "")) for part in content)
+    return chars // 3 + max_tokens
+
+def init_llm():
+    global llm_http_client
+    llm_http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS),
+        timeout=httpx.Timeout(LLM_TIMEOUT, connect=10.0)
+    )
+    # every key gets its own client but they share one connection pool
+    llm_clients[:] = [
+        AsyncGroq(api_key=key, http_client=llm_http_client, max_retries=1)
+        for key in GROQ_API_KEYS or [None]
+    ]
+    logger.info(f"LLM pool ready with {len(llm_clients)} key(s)")
+
+def get_llm_pool(model):
+    # groq rate limits are per key and per model, so each model tracks its own budgets
+    pool = llm_pools.get(model)
+    if pool is None:
+        pool = {"keys": [LLMKey(i, client) for i, client in enumerate(llm_clients)], "lock": asyncio.Lock()}
+        llm_pools[model] = pool
+    return pool
+
+async def close_llm():
+    if llm_http_client:
+        await llm_http_client.aclose()
+
+async def acquire_llm_key(model, estimate):
+    pool = get_llm_pool(model)
+    # one waiter per model at a time so queued calls are served in order
+    async with pool["lock"]:
+        queued = False
+        while True:
+            now = time.monotonic()
+            best, best_headroom = None, None
+            for key in pool["keys"]:
+                headroom = key.headroom(now)
+                if headroom is None or headroom < estimate:
+                    continue
+                if best is None or (headroom, -key.in_flight) > (best_headroom, -best.in_flight):
+                    best, best_headroom = key, headroom
+            if best is not None:
+                best.in_flight += 1
+                best.reserved_tokens += estimate
+                best.calls += 1
+                return best
+            if not queued:
+                queued = True
+                llm_stats["queued"] += 1
+            wake = min(key.next_change(now) for key in pool["keys"])
+            llm_key_released.clear()
+            try:
+                await asyncio.wait_for(llm_key_released.wait(), max(wake - now, 0.05))
+            except asyncio.TimeoutError:
+                pass
+
+def release_llm_key(key, estimate):
+    key.in_flight -= 1
+    key.reserved_tokens -= estimate
+    llm_key_released.set()
+
+def budget_retry_in(keys):
+    now = time.monotonic()
+    return max(min(key.next_change(now) for key in keys) - now, 1)
+
+async def open_llm_call(model, messages, max_tokens, timeout, estimate, fail_fast=False, **kwargs):
+    # fail_fast is set when the route still has another model; the last model queues for its keys instead
+    deadline = time.monotonic() + LLM_QUEUE_TIMEOUT
+    keys = get_llm_pool(model)["keys"]
+    now = time.monotonic()
+    if fail_fast and all(now < key.blocked_until for key in keys):
+        # every key got a 429 for this model; don't queue behind the retry-after, let the route fall back
+        raise LLMUnavailable(model, min(key.blocked_until for key in keys) - now, "rate limited")
+    while True:
+        try:
+            key = await asyncio.wait_for(acquire_llm_key(model, estimate), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            # our own budget ran out, not the model: keep it away from the breaker and tell the user how long
+            raise LLMUnavailable(model, budget_retry_in(keys), "rate budget spent")
+        try:
+            # wait_for cancels the in-flight request on timeout; a cancelled handler cancels it the same way
+            raw = await asyncio.wait_for(
+                key.client.chat.completions.with_raw_response.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    timeout=timeout,
+                    **kwargs
+                ),
+                timeout=timeout
+            )
+        except RateLimitError as e:
+            key.block(e.response.headers)
+            release_llm_key(key, estimate)
+            now = time.monotonic()
+            if fail_fast and not any((headroom := other.headroom(now)) is not None and headroom >= estimate for other in keys):
+                # every key is spent on this model: let the route fall back instead of waiting out the reset
+                logger.warning(f"Groq key {key.index} rate limited on {model}, no key left")
+                raise
+            logger.warning(f"Groq key {key.index} rate limited on {model}, rerouting")
+            continue
+        except BaseException:
+            release_llm_key(key, estimate)
+            raise
+        key.update(raw.headers)
+        return key, raw
+
+class LLMUnavailable(Exception):
+    def __init__(self, model, retry_in, reason="circuit open"):
+        super().__init__(f"{model} {reason}, retry in {retry_in:.0f}s")
+        self.model = model
+        self.retry_in = retry_in
+
+class CircuitBreaker:
+    def __init__(self, model):
+        self.model = model
+        self.state = "closed"
+        self.failures = 0
+        self.opens = 0
+        self.open_until = 0.0
+        self.probing = False
+    
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.probing or time.monotonic() < self.open_until:
+            return False
+        # after the backoff a single probe call decides whether the model is back
+        self.state = "half_open"
+        self.probing = True
+        return True
+    
+    def retry_in(self):
+        return max(self.open_until - time.monotonic(), 0)
+    
+    def record(self, healthy):
+        self.probing = False
+        if healthy is None:
+            return
+        if healthy:
+            if self.state != "closed":
+                logger.info(f"Circuit for {self.model} closed")
+            self.state = "closed"
+            self.failures = 0
+            self.opens = 0
+            return
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= BREAKER_FAILURES:
+            self.opens += 1
+            backoff = min(BREAKER_BASE_DELAY * 2 ** (self.opens - 1), BREAKER_MAX_DELAY)
+            # jitter so every worker does not probe the model at the same moment
+            self.open_until = time.monotonic() + random.uniform(backoff / 2, backoff)
+            self.state = "open"
+            logger.warning(f"Circuit for {self.model} opened for {self.retry_in():.0f}s after {self.failures} failures")
+    
+    def stats(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opens": self.opens,
+            "retry_in": round(self.retry_in(), 1)
+        }
+
+def get_breaker(model):
+    breaker = llm_breakers.get(model)
+    if breaker is None:
+        breaker = CircuitBreaker(model)
+        llm_breakers[model] = breaker
+    return breaker
+
+async def llm_complete(model, messages, max_tokens, timeout=LLM_TIMEOUT, fail_fast=False, **kwargs):
+    # an open circuit fails before queueing for a slot, the cap is usually full during an outage
+    breaker = get_breaker(model)
+    if not breaker.allow():
+        raise LLMUnavailable(model, breaker.retry_in())
+    healthy = None
+    try:
+        # global cap on outstanding calls; holders are bounded by the key queue and call timeouts
+        async with llm_semaphore:
+            estimate = estimate_tokens(messages, max_tokens)
+            key, raw = await open_llm_call(model, messages, max_tokens, timeout, estimate, fail_fast, **kwargs)
+            try:
+                response = await raw.parse()
+            finally:
+                release_llm_key(key, estimate)
+            healthy = True
+            return response.choices[0].message.content
+    except Exception as e:
+        # a 429 means the budget is spent, not that the model is down
+        if should_fall_back(e) and not isinstance(e, (RateLimitError, LLMUnavailable)):
+            healthy = False
+        raise
+    finally:
+        breaker.record(healthy)
+
+async def llm_stream(model, messages, max_tokens, timeout=LLM_TIMEOUT, fail_fast=False):
+    breaker = get_breaker(model)
+    if not breaker.allow():
+        raise LLMUnavailable(model, breaker.retry_in())
+    healthy = None
+    try:
+        async with llm_semaphore:
+            # same overall deadline as llm_complete, applied across the whole stream
+            deadline = time.monotonic() + timeout
+            estimate = estimate_tokens(messages, max_tokens)
+            key, raw = await open_llm_call(model, messages, max_tokens, timeout, estimate, fail_fast, stream=True)
+            try:
+                stream = await raw.parse()
+                try:
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(stream.__anext__(), max(deadline - time.monotonic(), 0))
+                        except StopAsyncIteration:
+                            healthy = True
+                            return
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            yield chunk.choices[0].delta.content
+                finally:
+                    await stream.close()
+            finally:
+                release_llm_key(key, estimate)
+    except Exception as e:
+        # a 429 means the budget is spent, not that the model is down
+        if should_fall_back(e) and not isinstance(e, (RateLimitError, LLMUnavailable)):
+            healthy = False
+        raise
+    finally:
+        breaker.record(healthy)
+
+def should_fall_back(error):
+    if isinstance(error, (asyncio.TimeoutError, RateLimitError, APIConnectionError, LLMUnavailable)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+async def llm_race(models, messages, max_tokens, timeout, **kwargs):
+    llm_stats["races"] += 1
+    calls = [asyncio.ensure_future(llm_complete(model, messages, max_tokens, timeout, **kwargs)) for model in models]
+    try:
+        error = None
+        for next_done in asyncio.as_completed(calls):
+            try:
+                return await next_done
+            except Exception as e:
+                if not should_fall_back(e):
+                    raise
+                error = e
+        raise error
+    finally:
+        for call in calls:
+            call.cancel()
+
+async def llm_route(task, messages, max_tokens, timeout=LLM_TIMEOUT, **kwargs):
+    models = MODEL_ROUTES[task]
+    if task in MODEL_RACE_TASKS and len(models) > 1:
+        return await llm_race(models[:2], messages, max_tokens, timeout, **kwargs)
+    for i, model in enumerate(models):
+        try:
+            return await llm_complete(model, messages, max_tokens, timeout, i < len(models) - 1, **kwargs)
+        except Exception as e:
+            if i == len(models) - 1 or not should_fall_back(e):
+                raise
+            llm_stats["fallbacks"] += 1
+            logger.warning(f"{model} failed for {task} ({type(e).__name__}), falling back to {models[i + 1]}")
+
+def horoscope_day():
+    return datetime.now().strftime("%Y-%m-%d")
+
+def load_horoscope(day, sign):
+    with db_lock:
+        row = db.execute("SELECT text FROM horoscopes WHERE day = ? AND sign = ?", (day, sign)).fetchone()
+    return row["text"] if row else None
+
+def save_horoscope(day, sign, text):
+    with db_lock, db:
+        db.execute("INSERT OR REPLACE INTO horoscopes (day, sign, text) VALUES (?, ?, ?)", (day, sign, text))
+
+def prune_horoscopes(day):
+    with db_lock, db:
+        db.execute("DELETE FROM horoscopes WHERE day < ?", (day,))
+
+async def generate_horoscope(day, sign):
+    horoscope = await asyncio.to_thread(load_horoscope, day, sign)
+    if horoscope is None:
+        sign_name = ZODIAC_SIGNS.get(sign, sign)
+        messages = [
+            {"role": "system", "content": "انت خبير ابراج ومنجم محترف. اكتب توقعات يومية شاملة ومفصلة بالعربي."},
+            {"role": "user", "content": f"اكتب توقعات برج {sign_name} لهذا اليوم {day}. اذكر الحب والعمل والصحة والمال والنصيحة."}
+        ]
+        horoscope = clean_markdown(await llm_route("horoscope", messages, 1000))
+        await asyncio.to_thread(save_horoscope, day, sign, horoscope)
+        horoscope_stats["generated"] += 1
+    horoscopes[(day, sign)] = horoscope
+    return horoscope
+
+def horoscope_flight(day, sign):
+    # concurrent taps on the same sign share one generation
+    key = (day, sign)
+    task = horoscope_tasks.get(key)
+    if task is None:
+        task = asyncio.ensure_future(generate_horoscope(day, sign))
+        horoscope_tasks[key] = task
+        task.add_done_callback(lambda t: horoscope_tasks.pop(key, None))
+    return asyncio.shield(task)
+
+def cached_horoscope(sign):
+    horoscope = horoscopes.get((horoscope_day(), sign))
+    if horoscope is not None:
+        horoscope_stats["hits"] += 1
+    return horoscope
+
+async def get_horoscope(sign):
+    horoscope_stats["misses"] += 1
+    return await horoscope_flight(horoscope_day(), sign)
+
+async def pregenerate_horoscopes(context: ContextTypes.DEFAULT_TYPE):
+    day = horoscope_day()
+    for key in [key for key in horoscopes if key[0] != day]:
+        del horoscopes[key]
+    await asyncio.to_thread(prune_horoscopes, day)
+    
+    for sign in ZODIAC_SIGNS:
+        if (day, sign) in horoscopes:
+            continue
+        try:
+            await horoscope_flight(day, sign)
+        except Exception as e:
+            logger.error(f"Error pre-generating horoscope for {sign}: {e}")
+    logger.info(f"Horoscopes ready for {day}: {sum(1 for key in horoscopes if key[0] == day)}/{len(ZODIAC_SIGNS)}")
+
+def load_game_pools():
+    with db_lock:
+        rows = db.execute("SELECT * FROM game_questions WHERE served = 0 ORDER BY id").fetchall()
+    for pool in game_pools.values():
+        pool.clear()
+    for row in rows:
+        if row["game_type"] in game_pools:
+            game_pools[row["game_type"]].append({
+                "id": row["id"],
+                "question": row["question"],
+                "options": json.loads(row["options"]),
+                "answer": row["answer"]
+            })
+    logger.info(f"Loaded game pools: {', '.join(f'{t}={len(p)}' for t, p in game_pools.items())}")
+
+def save_game_questions(game_type, questions):
+    added = []
+    with db_lock, db:
+        for question in questions:
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO game_questions (game_type, fingerprint, question, options, answer) VALUES (?, ?, ?, ?, ?)",
+                (game_type, question["fingerprint"], question["question"], json.dumps(question["options"], ensure_ascii=False), question["answer"])
+            )
+            if cursor.rowcount:
+                added.append({
+                    "id": cursor.lastrowid,
+                    "question": question["question"],
+                    "options": question["options"],
+                    "answer": question["answer"]
+                })
+        # served questions stay around only so new batches can be checked against them
+        db.execute(
+            "DELETE FROM game_questions WHERE game_type = ? AND served = 1 AND id NOT IN "
+            "(SELECT id FROM game_questions WHERE game_type = ? AND served = 1 ORDER BY id DESC LIMIT ?)",
+            (game_type, game_type, GAME_SERVED_KEEP)
+        )
+    return added
+
+def mark_game_served(question_id):
+    with db_lock, db:
+        db.execute("UPDATE game_questions SET served = 1 WHERE id = ?", (question_id,))
+
+def parse_json_object(raw):
+    # JSON mode should return a bare object, but tolerate chatter around it
+    start, end = raw.find("{"), raw.rfind("}")
+    if start == -1 or end == -1:
+        return {}
+    try:
+        data = json.loads(raw[start:end + 1])
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def parse_game_batch(raw):
+    items = parse_json_object(raw).get("questions")
+    if not isinstance(items, list):
+        return []
+    
+    questions = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        question = item.get("question")
+        options = item.get("options")
+        answer = item.get("answer")
+        if not isinstance(question, str) or not question.strip():
+            continue
+        if not isinstance(options, list) or len(options) != 4:
+            continue
+        options = [str(option).strip() for option in options]
+        if not all(options) or len(set(options)) != 4:
+            continue
+        if isinstance(answer, str):
+            answer = answer.strip().lower().replace("ا", "أ")
+            if answer in GAME_LETTERS:
+                answer = GAME_LETTERS.index(answer)
+            elif answer in GAME_LETTERS_AR:
+                answer = GAME_LETTERS_AR.index(answer)
+            elif answer.isdigit():
+                answer = int(answer)
+        if not isinstance(answer, int) or isinstance(answer, bool) or not 0 <= answer <= 3:
+            continue
+        
+        # models put the right answer first far too often, so the options are shuffled before storing
+        correct = options[answer]
+        random.shuffle(options)
+        normalized = re.sub(r'\W+', ' ', question).strip().lower()
+        questions.append({
+            "fingerprint": hashlib.sha1(normalized.encode("utf-8")).hexdigest(),
+            "question": clean_markdown(question),
+            "options": options,
+            "answer": GAME_LETTERS[options.index(correct)]
+        })
+    game_stats["rejected"] += len(items) - len(questions)
+    return questions
+
+async def refill_game_pool(game_type):
+    messages = [
+        {"role": "system", "content": 'انت مقدم العاب ذكاء. رجع JSON فقط بهالشكل: {"questions": [{"question": "نص السؤال", "options": ["خيار", "خيار", "خيار", "خيار"], "answer": 0}]} و answer هو رقم الخيار الصحيح من 0 الى 3.'},
+        {"role": "user", "content": f"اعطني {GAME_BATCH_SIZE} اسئلة {GAME_TYPES[game_type]} صعبة ومتنوعة بالعربي، كل سؤال مع 4 خيارات وجواب واحد صحيح، وبدون تكرار."}
+    ]
+    for attempt in range(3):
+        if len(game_pools[game_type]) >= GAME_POOL_TARGET:
+            return
+        raw = await llm_route("game", messages, GAME_BATCH_SIZE * 300, response_format={"type": "json_object"})
+        questions = parse_game_batch(raw)
+        added = await asyncio.to_thread(save_game_questions, game_type, questions)
+        game_stats["generated"] += len(added)
+        game_stats["duplicates"] += len(questions) - len(added)
+        game_pools[game_type].extend(added)
+        logger.info(f"Game pool {game_type}: +{len(added)} questions, {len(game_pools[game_type])} ready")
+        if added:
+            game_ready[game_type].set()
+
+def log_refill_error(task):
+    if not task.cancelled() and task.exception():
+        logger.error(f"Error refilling game pool: {task.exception()}")
+
+def schedule_game_refill(game_type):
+    # one refill per game type at a time; taps on an empty pool wait on the same batch
+    task = game_refills.get(game_type)
+    if task is None or task.done():
+        ready = game_ready[game_type] = asyncio.Event()
+        task = asyncio.ensure_future(refill_game_pool(game_type))
+        task.add_done_callback(log_refill_error)
+        task.add_done_callback(lambda _: ready.set())
+        game_refills[game_type] = task
+    return task
+
+async def wait_game_refill(game_type):
+    # taps only need the next batch; the rest of the refill keeps going in the background
+    while not game_pools[game_type]:
+        task = schedule_game_refill(game_type)
+        ready = game_ready[game_type]
+        if ready.is_set() and not task.done():
+            # an earlier batch was already drained by other taps, wait for the next one
+            ready.clear()
+        await ready.wait()
+        if not game_pools[game_type] and task.done():
+            if not task.cancelled() and task.exception():
+                raise task.exception()
+            return
+
+def pop_game_question(game_type):
+    pool = game_pools[game_type]
+    question = pool.popleft() if pool else None
+    if len(pool) < GAME_POOL_LOW:
+        schedule_game_refill(game_type)
+    return question
+
+async def fill_game_pools(context: ContextTypes.DEFAULT_TYPE):
+    for game_type in GAME_TYPES:
+        if len(game_pools[game_type]) < GAME_POOL_TARGET:
+            try:
+                await asyncio.shield(schedule_game_refill(game_type))
+            except Exception:
+                # already logged by the refill task
+                pass
+
+def format_game_question(question):
+    options = "\n".join(f"{letter}) {option}" for letter, option in zip(GAME_LETTERS_AR, question["options"]))
+    return f"{question['question']}\n\n{options}"
+
+# langdetect is random by default, so the same text could flip between two close languages
+DetectorFactory.seed = 0
+
+# letters that decide the language on their own, no profile matching needed
+LANGUAGE_SCRIPTS = [
+    ("ar", ((0x0600, 0x06FF), (0x0750, 0x077F), (0x08A0, 0x08FF), (0xFB50, 0xFDFF), (0xFE70, 0xFEFF))),
+    ("ja", ((0x3040, 0x30FF), (0x31F0, 0x31FF))),
+    ("ko", ((0x1100, 0x11FF), (0x3130, 0x318F), (0xAC00, 0xD7AF))),
+    ("zh-cn", ((0x4E00, 0x9FFF), (0x3400, 0x4DBF))),
+    ("ru", ((0x0400, 0x04FF),)),
+    ("el", ((0x0370, 0x03FF),)),
+    ("hi", ((0x0900, 0x097F),)),
+    ("he", ((0x0590, 0x05FF),)),
+    ("th", ((0x0E00, 0x0E7F),)),
+]
+# چ and گ are left out on purpose: Iraqi and Gulf Arabic write them all the time
+PERSIAN_LETTERS = set("پژکی")
+URDU_LETTERS = set("ٹڈڑںےہ")
+ARABIC_ONLY_LETTERS = set("يكةى")
+UKRAINIAN_LETTERS = set("іїєґІЇЄҐ")
+
+def script_of(char):
+    code = ord(char)
+    for lang, ranges in LANGUAGE_SCRIPTS:
+        for start, end in ranges:
+            if start <= code <= end:
+                return lang
+    return None
+
+def detect_script_language(sample):
+    counts = {}
+    letters = 0
+    for char in sample:
+        if not char.isalpha():
+            continue
+        letters += 1
+        lang = script_of(char)
+        if lang:
+            counts[lang] = counts.get(lang, 0) + 1
+    if not letters:
+        return None
+    # kana next to kanji is Japanese, han on its own is Chinese
+    if counts.get("ja") and counts.get("zh-cn"):
+        counts["ja"] += counts.pop("zh-cn")
+    if not counts:
+        return None
+    lang, count = max(counts.items(), key=lambda item: item[1])
+    if count / letters < LANGDETECT_SCRIPT_RATIO:
+        return None
+    if lang == "ar":
+        # the arabic script is shared: persian and urdu need a real share of their own letters,
+        # and more of them than the letters only arabic uses, before one stray letter can decide
+        arabic_only = sum(char in ARABIC_ONLY_LETTERS for char in sample)
+        for script_lang, script_letters in (("ur", URDU_LETTERS), ("fa", PERSIAN_LETTERS)):
+            own = sum(char in script_letters for char in sample)
+            if own > arabic_only and own / count >= LANGDETECT_PERSIAN_RATIO:
+                return script_lang
+    if lang == "ru" and set(sample) & UKRAINIAN_LETTERS:
+        return "uk"
+    return lang
+
+def detect_language(text):
+    sample = " ".join(text[:LANGDETECT_SAMPLE_CHARS].split())
+    if not sample:
+        return None
+    key = hashlib.sha1(sample.encode("utf-8")).hexdigest()
+    cached = language_cache.get(key)
+    if cached is not None:
+        return cached
+    lang = detect_script_language(sample)
+    if lang:
+        langdetect_stats["script"] += 1
+    else:
+        # latin and mixed text still needs the n-gram profiles, but only on a bounded prefix
+        try:
+            lang = detect(sample)
+            langdetect_stats["langdetect"] += 1
+        except Exception:
+            langdetect_stats["failed"] += 1
+            return None
+    language_cache.set(key, lang)
+    return lang
+
+def warm_language_detector():
+    # the first detect() loads every language profile from disk, do it before users are waiting
+    started = time.monotonic()
+    try:
+        detect("warming up the language detector")
+    except Exception as e:
+        logger.error(f"Language detector warm-up error: {e}")
+        return
+    logger.info(f"Language detector ready in {time.monotonic() - started:.2f}s")
+
+def translation_key(text, lang):
+    normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+    return (hashlib.sha1(normalized.encode("utf-8")).hexdigest(), lang)
+
+async def fetch_translation(text, lang):
+    messages = [
+        {"role": "system", "content": f"انت مترجم محترف. ترجم النص التالي الى {LANGUAGES.get(lang, lang)} فقط بدون اي شرح او اضافات."},
+        {"role": "user", "content": text}
+    ]
+    translated = clean_markdown(await llm_route("translate", messages, 2000))
+    translation_cache.set(translation_key(text, lang), translated)
+    return translated
+
+async def translate_many(text, langs):
+    results = {}
+    missing = []
+    for lang in langs:
+        cached = translation_cache.get(translation_key(text, lang))
+        if cached is None:
+            missing.append(lang)
+        else:
+            results[lang] = cached
+    
+    if len(missing) > 1:
+        # one structured request for every language instead of a round-trip each
+        targets = ", ".join(f"{lang} ({LANGUAGES.get(lang, lang)})" for lang in missing)
+        messages = [
+            {"role": "system", "content": f'انت مترجم محترف. ترجم النص الى هاللغات: {targets}. رجع JSON فقط بهالشكل: {{"translations": {{"رمز اللغة": "الترجمة"}}}} بدون اي شرح او اضافات.'},
+            {"role": "user", "content": text}
+        ]
+        raw = await llm_route("translate", messages, min(2000 * len(missing), 8000), response_format={"type": "json_object"})
+        translations = parse_json_object(raw).get("translations")
+        for lang in missing:
+            translated = translations.get(lang) if isinstance(translations, dict) else None
+            if isinstance(translated, str) and translated.strip():
+                results[lang] = clean_markdown(translated)
+                translation_cache.set(translation_key(text, lang), results[lang])
+        missing = [lang for lang in missing if lang not in results]
+    
+    if missing:
+        for lang, translated in zip(missing, await asyncio.gather(*(fetch_translation(text, lang) for lang in missing))):
+            results[lang] = translated
+    return {lang: results[lang] for lang in langs}
+
+def split_tts_text(text, limit=TTS_CHUNK_CHARS):
+    sentences = re.split(r'(?<=[.!?؟\n])\s+', text.strip())
+    chunks = []
+    current = ""
+    for sentence in sentences:
+        while len(sentence) > limit:
+            cut = sentence.rfind(" ", 0, limit)
+            if cut <= 0:
+                cut = limit
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        if current and len(current) + 1 + len(sentence) > limit:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}".strip()
+    if current:
+        chunks.append(current)
+    return chunks
+
+def synthesize_chunk(text, lang):
+    audio = BytesIO()
+    gTTS(text=text, lang=lang, timeout=TTS_TIMEOUT).write_to_fp(audio)
+    return audio.getvalue()
+
+async def synthesize_speech(text, lang):
+    # MP3 frames concatenate cleanly, so chunks are synthesized in parallel and joined in order
+    loop = asyncio.get_running_loop()
+    chunks = split_tts_text(text)
+    parts = await asyncio.gather(*(loop.run_in_executor(tts_executor, synthesize_chunk, chunk, lang) for chunk in chunks))
+    tts_stats["synthesized"] += 1
+    tts_stats["chunks"] += len(chunks)
+    return b"".join(parts)
+
+def load_tts_file_id(text_hash, lang):
+    with db_lock:
+        row = db.execute("SELECT file_id FROM tts_cache WHERE text_hash = ? AND lang = ?", (text_hash, lang)).fetchone()
+    return row["file_id"] if row else None
+
+def save_tts_file_id(text_hash, lang, file_id):
+    with db_lock, db:
+        db.execute("INSERT OR REPLACE INTO tts_cache (text_hash, lang, file_id) VALUES (?, ?, ?)", (text_hash, lang, file_id))
+
+def llm_error_text(error, default):
+    # tell users how long to wait instead of inviting an instant retry while the model is down
+    if isinstance(error, LLMUnavailable):
+        return f"في ضغط كبير على الخدمة هلق، جرب بعد {max(round(error.retry_in), 1)} ثانية ⏳"
+    if isinstance(error, RateLimitError):
+        try:
+            retry_in = float(error.response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            retry_in = 10
+        return f"في ضغط كبير على الخدمة هلق، جرب بعد {max(round(retry_in), 1)} ثانية ⏳"
+    return default
 
 def clean_markdown(text):
     text = re.sub(r'\*\*(.+?)\*\*', r'\1', text)
@@ -170,21 +1797,230 @@ def clean_markdown(text):
     text = re.sub(r'^\s*\d+\.\s+', '', text, flags=re.MULTILINE)
     return text.strip()
 
+def split_message_text(text, limit=MESSAGE_PAGE_CHARS):
+    pages = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        pages.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    pages.append(text)
+    return pages
+
+class StreamingReply:
+    def __init__(self, bot, message, progress_markup=None):
+        self.bot = bot
+        self.messages = [message]
+        self.shown = [None]
+        self.progress_markup = progress_markup
+        self.raw = ""
+        self.cleaned_lines = []
+        self.cleaned_upto = 0
+        self.next_edit = 0
+    
+    def feed(self, delta):
+        self.raw += delta
+    
+    def render(self):
+        # completed lines are cleaned once and kept, only the unfinished tail is re-cleaned on every edit
+        end = self.raw.rfind("\n") + 1
+        if end > self.cleaned_upto:
+            for line in self.raw[self.cleaned_upto:end].split("\n")[:-1]:
+                self.cleaned_lines.append(clean_markdown(line))
+            self.cleaned_upto = end
+        return "\n".join(self.cleaned_lines + [clean_markdown(self.raw[self.cleaned_upto:])]).strip()
+    
+    async def update(self):
+        if time.monotonic() < self.next_edit:
+            return
+        text = self.render()
+        if text:
+            await self.show(text + " ▌", self.progress_markup, final=False)
+        self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+    
+    async def show(self, text, reply_markup, final=True):
+        pages = split_message_text(text)
+        for i, page in enumerate(pages):
+            body = f"الحل:\n\n{page}" if i == 0 else f"تكملة الحل:\n\n{page}"
+            markup = reply_markup if i == len(pages) - 1 else None
+            shown = (body, markup.to_json() if markup else None)
+            if i < len(self.shown) and self.shown[i] == shown:
+                continue
+            # progress edits give up on the first RetryAfter, the final render retries until it lands
+            while True:
+                try:
+                    if i < len(self.messages):
+                        await self.messages[i].edit_text(body, reply_markup=markup)
+                    else:
+                        self.messages.append(await self.bot.send_message(
+                            chat_id=self.messages[0].chat_id,
+                            text=body,
+                            reply_markup=markup
+                        ))
+                        self.shown.append(None)
+                    self.shown[i] = shown
+                    break
+                except RetryAfter as e:
+                    retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                    self.next_edit = time.monotonic() + retry_after
+                    if not final:
+                        return
+                    await asyncio.sleep(retry_after)
+                except BadRequest as e:
+                    if "not modified" not in str(e):
+                        raise
+                    self.shown[i] = shown
+                    break
+        if final:
+            for message in self.messages[len(pages):]:
+                try:
+                    await message.delete()
+                except Exception as e:
+                    logger.error(f"Error deleting stale answer page: {e}")
+            del self.messages[len(pages):]
+            del self.shown[len(pages):]
+
+async def reply_answer(message, answer, reply_markup):
+    # cached answers can be as long as streamed ones, so they go out in the same pages
+    pages = split_message_text(answer)
+    for i, page in enumerate(pages):
+        await message.reply_text(
+            f"الحل:\n\n{page}" if i == 0 else f"تكملة الحل:\n\n{page}",
+            reply_markup=reply_markup if i == len(pages) - 1 else None
+        )
+
+async def stream_answer(bot, processing_msg, task, messages, max_tokens, progress_markup=None):
+    reply = StreamingReply(bot, processing_msg, progress_markup)
+    if STREAM_RESPONSES:
+        models = MODEL_ROUTES[task]
+        for i, model in enumerate(models):
+            stream = llm_stream(model, messages, max_tokens, fail_fast=i < len(models) - 1)
+            try:
+                async for delta in stream:
+                    reply.feed(delta)
+                    await reply.update()
+                break
+            except Exception as e:
+                # once text is on screen a retry would restart it, so only fall back before the first token
+                if reply.raw or i == len(models) - 1 or not should_fall_back(e):
+                    raise
+                llm_stats["fallbacks"] += 1
+                logger.warning(f"{model} failed for {task} ({type(e).__name__}), falling back to {models[i + 1]}")
+            finally:
+                await stream.aclose()
+    else:
+        reply.feed(await llm_route(task, messages, max_tokens))
+    answer = clean_markdown(reply.raw)
+    await reply.show(answer, get_rating_keyboard())
+    return answer
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        # the base semaphore is taken before the per-user lock, so a bound there lets one flooding user
+        # hold every slot; keep it effectively unlimited and cap queued updates per user instead
+        super().__init__(2 ** 30)
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._user_locks = {}
+    
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._running:
+                await coroutine
+            return
+        
+        entry = self._user_locks.setdefault(user.id, {"lock": asyncio.Lock(), "pending": 0})
+        if entry["pending"] >= USER_MAX_PENDING_UPDATES:
+            admission_stats["updates_dropped"] += 1
+            coroutine.close()
+            if update.callback_query:
+                try:
+                    await update.callback_query.answer("استنى شوي، لسا عم نفذ طلباتك السابقة ⏳")
+                except Exception as e:
+                    logger.error(f"Error answering dropped callback: {e}")
+            return
+        entry["pending"] += 1
+        try:
+            async with entry["lock"]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry["pending"] -= 1
+            if entry["pending"] == 0:
+                del self._user_locks[user.id]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+async def start_solve(update: Update, context: ContextTypes.DEFAULT_TYPE, solve, *args):
+    user = update.effective_user
+    # limits and supersede apply per solve type, so a follow-up text never cancels a PDF in progress
+    running = [task for task in solve_tasks.get(user.id, []) if not task.done() and task.get_name() == solve.__name__]
+    if len(running) >= USER_MAX_SOLVES and not USER_SUPERSEDE:
+        admission_stats["rejected"] += 1
+        await update.effective_message.reply_text("لسا عم بحل سؤالك السابق، استنى يخلص وبعدين ابعت الجديد")
+        return
+    
+    bucket = user_buckets.get(user.id)
+    if bucket is None:
+        bucket = TokenBucket(rate=USER_SOLVES_PER_MINUTE / 60, capacity=USER_SOLVE_BURST)
+        user_buckets.set(user.id, bucket)
+    if not bucket.try_acquire():
+        admission_stats["rate_limited"] += 1
+        await update.effective_message.reply_text(f"بعتت اسئلة كتير ورا بعض، استنى {int(bucket.wait_time()) + 1} ثانية وجرب كمان مرة ⏳")
+        return
+    
+    # the newest question wins, older ones of the same type for the same user are cancelled
+    for task in running[:len(running) - USER_MAX_SOLVES + 1]:
+        admission_stats["superseded"] += 1
+        task.cancel()
+    
+    # run outside the per-user update lock so later updates (cancel, a newer question) can reach the job
+    task = context.application.create_task(solve(update, context, *args), name=solve.__name__)
+    solve_tasks.setdefault(user.id, []).append(task)
+    task.add_done_callback(lambda t: forget_solve(user.id, t))
+
+def forget_solve(user_id, task):
+    tasks = solve_tasks.get(user_id)
+    if tasks and task in tasks:
+        tasks.remove(task)
+        if not tasks:
+            del solve_tasks[user_id]
+
 def is_private_chat(update: Update) -> bool:
     return update.effective_chat.type == ChatType.PRIVATE
 
-async def check_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+def cache_subscription(user_id, subscribed):
+    subscription_cache.set(user_id, subscribed, ttl=SUBSCRIPTION_TTL if subscribed else SUBSCRIPTION_NEGATIVE_TTL)
+
+async def check_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE, force: bool = False) -> bool:
+    if not force:
+        cached = subscription_cache.get(user_id)
+        if cached is not None:
+            return cached
+    
     try:
         member = await context.bot.get_chat_member(chat_id=REQUIRED_CHANNEL, user_id=user_id)
-        return member.status in ['member', 'administrator', 'creator']
     except Exception as e:
         logger.error(f"Error checking subscription: {e}")
         return False
+    subscribed = member.status in SUBSCRIBED_STATUSES
+    cache_subscription(user_id, subscribed)
+    return subscribed
+
+async def handle_channel_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    change = update.chat_member
+    if not change.chat.username or change.chat.username.lower() != REQUIRED_CHANNEL[1:].lower():
+        return
+    cache_subscription(change.new_chat_member.user.id, change.new_chat_member.status in SUBSCRIBED_STATUSES)
 
 async def notify_developer(context: ContextTypes.DEFAULT_TYPE, user):
     try:
-        members = load_members()
-        total = len(members)
+        total, _ = get_member_stats()
         msg = f"مستخدم جديد دخل البوت\n\nالاسم: {user.first_name}\nاليوزر: @{user.username if user.username else 'بدون'}\nالايدي: {user.id}\n\nاجمالي المستخدمين: {total}"
         dev_chat = await context.bot.get_chat(f"@{DEVELOPER_USERNAME}")
         await context.bot.send_message(chat_id=dev_chat.id, text=msg)
@@ -224,6 +2060,12 @@ def get_pdf_details_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+def get_pdf_cancel_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("الغاء ❌", callback_data="pdf_cancel")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
 def get_vip_keyboard():
     keyboard = [
         [InlineKeyboardButton("ترجمة 🌍", callback_data="vip_translate"),
@@ -235,7 +2077,8 @@ def get_vip_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def get_language_keyboard(page=0):
+def get_language_keyboard(page=0, selected=None):
+    # selected is None for a single target, otherwise the languages ticked so far
     lang_list = list(LANGUAGES.items())
     per_page = 8
     start = page * per_page
@@ -245,7 +2088,10 @@ def get_language_keyboard(page=0):
     keyboard = []
     row = []
     for i, (code, name) in enumerate(current_langs):
-        row.append(InlineKeyboardButton(name, callback_data=f"translate_to_{code}"))
+        if selected is None:
+            row.append(InlineKeyboardButton(name, callback_data=f"translate_to_{code}"))
+        else:
+            row.append(InlineKeyboardButton(f"✅ {name}" if code in selected else name, callback_data=f"translate_pick_{code}_{page}"))
         if len(row) == 2:
             keyboard.append(row)
             row = []
@@ -260,6 +2106,10 @@ def get_language_keyboard(page=0):
     if nav_row:
         keyboard.append(nav_row)
     
+    if selected is None:
+        keyboard.append([InlineKeyboardButton("ترجمة لعدة لغات 🌐", callback_data="translate_multi_start")])
+    elif selected:
+        keyboard.append([InlineKeyboardButton(f"ترجم للغات المختارة ({len(selected)}) ✅", callback_data="translate_multi")])
     keyboard.append([InlineKeyboardButton("رجوع 🔙", callback_data="vip_menu")])
     return InlineKeyboardMarkup(keyboard)
 
@@ -323,13 +2173,13 @@ def get_story_choice_keyboard(story_id):
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def get_game_answer_keyboard(correct_answer):
+def get_game_answer_keyboard(correct_answer, game_type="trivia"):
     keyboard = [
-        [InlineKeyboardButton("أ", callback_data=f"game_answer_a_{correct_answer}"),
-         InlineKeyboardButton("ب", callback_data=f"game_answer_b_{correct_answer}")],
-        [InlineKeyboardButton("ج", callback_data=f"game_answer_c_{correct_answer}"),
-         InlineKeyboardButton("د", callback_data=f"game_answer_d_{correct_answer}")],
-        [InlineKeyboardButton("سؤال جديد 🔄", callback_data="game_trivia")]
+        [InlineKeyboardButton("أ", callback_data=f"game_answer_a_{correct_answer}_{game_type}"),
+         InlineKeyboardButton("ب", callback_data=f"game_answer_b_{correct_answer}_{game_type}")],
+        [InlineKeyboardButton("ج", callback_data=f"game_answer_c_{correct_answer}_{game_type}"),
+         InlineKeyboardButton("د", callback_data=f"game_answer_d_{correct_answer}_{game_type}")],
+        [InlineKeyboardButton("سؤال جديد 🔄", callback_data=f"game_{game_type}")]
     ]
     return InlineKeyboardMarkup(keyboard)
 
@@ -413,7 +2263,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if query.data == "check_subscription":
-        if await check_subscription(user.id, context):
+        if await check_subscription(user.id, context, force=True):
             personality = get_user_personality(user.id)
             if not personality:
                 await query.edit_message_text(
@@ -521,16 +2371,37 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif query.data.startswith("lang_page_"):
         page = int(query.data.replace("lang_page_", ""))
+        selected = context.user_data.get('translate_targets')
         await query.edit_message_text(
-            "🌍 قم باختيار لغة الترجمة:",
-            reply_markup=get_language_keyboard(page)
+            "🌍 قم باختيار لغة الترجمة:" if selected is None else f"🌐 اختار لحد {TRANSLATE_MAX_TARGETS} لغات:",
+            reply_markup=get_language_keyboard(page, selected)
         )
     
-    elif query.data.startswith("translate_to_"):
-        target_lang = query.data.replace("translate_to_", "")
+    elif query.data == "translate_multi_start":
+        context.user_data['translate_targets'] = []
+        await query.edit_message_text(
+            f"🌐 اختار لحد {TRANSLATE_MAX_TARGETS} لغات:",
+            reply_markup=get_language_keyboard(0, [])
+        )
+    
+    elif query.data.startswith("translate_pick_"):
+        code, page = query.data.replace("translate_pick_", "").rsplit("_", 1)
+        selected = context.user_data.get('translate_targets') or []
+        if code in selected:
+            selected.remove(code)
+        elif len(selected) < TRANSLATE_MAX_TARGETS:
+            selected.append(code)
+        else:
+            await query.answer(f"بتقدر تختار {TRANSLATE_MAX_TARGETS} لغات بالكتير", show_alert=True)
+            return
+        context.user_data['translate_targets'] = selected
+        await query.edit_message_reply_markup(reply_markup=get_language_keyboard(int(page), selected))
+    
+    elif query.data == "translate_multi":
+        targets = context.user_data.get('translate_targets') or []
         text_to_translate = context.user_data.get('text_to_translate', '')
         
-        if not text_to_translate:
+        if not text_to_translate or not targets:
             await query.edit_message_text(
                 "لم يتم العثور على نص للترجمة. اكتب النص اولا.",
                 reply_markup=get_vip_keyboard()
@@ -540,19 +2411,45 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         processing_msg = await query.edit_message_text("جاري الترجمة... 🔄")
         
         try:
-            messages = [
-                {"role": "system", "content": f"انت مترجم محترف. ترجم النص التالي الى {LANGUAGES.get(target_lang, target_lang)} فقط بدون اي شرح او اضافات."},
-                {"role": "user", "content": text_to_translate}
-            ]
+            async with work_lanes["vip"].slot(processing_msg, "جاري الترجمة... 🔄"):
+                translations = await translate_many(text_to_translate, targets)
             
-            response = groq_client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=messages,
-                max_tokens=2000
+            result = "\n\n".join(f"🌍 {LANGUAGES.get(lang, lang)}:\n{translated}" for lang, translated in translations.items())
+            pages = split_message_text(result)
+            for i, page in enumerate(pages):
+                markup = get_vip_keyboard() if i == len(pages) - 1 else None
+                if i == 0:
+                    await processing_msg.edit_text(page, reply_markup=markup)
+                else:
+                    await context.bot.send_message(chat_id=processing_msg.chat_id, text=page, reply_markup=markup)
+        except Exception as e:
+            logger.error(f"Translation error: {e}")
+            await processing_msg.edit_text(
+                llm_error_text(e, "حصل خطأ في الترجمة، جرب كمان مرة"),
+                reply_markup=get_vip_keyboard()
             )
-            
-            translated = response.choices[0].message.content
-            translated = clean_markdown(translated)
+    
+    elif query.data.startswith("translate_to_"):
+        target_lang = query.data.replace("translate_to_", "")
+        text_to_translate = context.user_data.get('text_to_translate', '')
+        
+        if not text_to_translate:
+            await query.edit_message_text(
+                "لم يتم العثور على نص للترجمة. اكتب النص اولا.",
+                reply_markup=get_vip_keyboard()
+            )
+            return
+        
+        translated = translation_cache.get(translation_key(text_to_translate, target_lang))
+        if translated is None:
+            processing_msg = await query.edit_message_text("جاري الترجمة... 🔄")
+        else:
+            processing_msg = query.message
+        
+        try:
+            if translated is None:
+                async with work_lanes["vip"].slot(processing_msg, "جاري الترجمة... 🔄"):
+                    translated = await fetch_translation(text_to_translate, target_lang)
             
             await processing_msg.edit_text(
                 f"🌍 الترجمة الى {LANGUAGES.get(target_lang, target_lang)}:\n\n{translated}",
@@ -561,7 +2458,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logger.error(f"Translation error: {e}")
             await processing_msg.edit_text(
-                "حصل خطأ في الترجمة، جرب كمان مرة",
+                llm_error_text(e, "حصل خطأ في الترجمة، جرب كمان مرة"),
                 reply_markup=get_vip_keyboard()
             )
     
@@ -575,23 +2472,16 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         sign = query.data.replace("zodiac_", "")
         sign_name = ZODIAC_SIGNS.get(sign, sign)
         
-        processing_msg = await query.edit_message_text(f"جاري تحضير توقعات {sign_name}... 🔮")
+        horoscope = cached_horoscope(sign)
+        if horoscope is None:
+            processing_msg = await query.edit_message_text(f"جاري تحضير توقعات {sign_name}... 🔮")
+        else:
+            processing_msg = query.message
         
         try:
-            today = datetime.now().strftime("%Y-%m-%d")
-            messages = [
-                {"role": "system", "content": "انت خبير ابراج ومنجم محترف. اكتب توقعات يومية شاملة ومفصلة بالعربي."},
-                {"role": "user", "content": f"اكتب توقعات برج {sign_name} لهذا اليوم {today}. اذكر الحب والعمل والصحة والمال والنصيحة."}
-            ]
-            
-            response = groq_client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=messages,
-                max_tokens=1000
-            )
-            
-            horoscope = response.choices[0].message.content
-            horoscope = clean_markdown(horoscope)
+            if horoscope is None:
+                async with work_lanes["vip"].slot(processing_msg, f"جاري تحضير توقعات {sign_name}... 🔮"):
+                    horoscope = await get_horoscope(sign)
             
             await processing_msg.edit_text(
                 f"🔮 توقعات {sign_name} لهذا اليوم:\n\n{horoscope}",
@@ -603,7 +2493,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logger.error(f"Horoscope error: {e}")
             await processing_msg.edit_text(
-                "حصل خطأ، جرب كمان مرة",
+                llm_error_text(e, "حصل خطأ، جرب كمان مرة"),
                 reply_markup=get_vip_keyboard()
             )
     
@@ -630,13 +2520,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 {"role": "user", "content": f"اكتب بداية قصة {story_types.get(story_type, 'مغامرة')} تفاعلية قصيرة ومشوقة. في النهاية اعطي خيارين."}
             ]
             
-            response = groq_client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=messages,
-                max_tokens=1000
-            )
-            
-            story = response.choices[0].message.content
+            async with work_lanes["vip"].slot(processing_msg, "جاري كتابة القصة... ✍️"):
+                story = await llm_route("story", messages, 1000)
             story = clean_markdown(story)
             context.user_data['current_story'] = story
             context.user_data['story_type'] = story_type
@@ -648,7 +2533,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logger.error(f"Story error: {e}")
             await processing_msg.edit_text(
-                "حصل خطأ، جرب كمان مرة",
+                llm_error_text(e, "حصل خطأ، جرب كمان مرة"),
                 reply_markup=get_story_keyboard()
             )
     
@@ -667,13 +2552,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 {"role": "user", "content": f"القصة السابقة:\n{previous_story}\n\nاختار القارئ الخيار رقم {choice}. اكمل القصة واعطي خيارين جديدين."}
             ]
             
-            response = groq_client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=messages,
-                max_tokens=1000
-            )
-            
-            story = response.choices[0].message.content
+            async with work_lanes["vip"].slot(processing_msg, "جاري اكمال القصة... ✍️"):
+                story = await llm_route("story", messages, 1000)
             story = clean_markdown(story)
             context.user_data['current_story'] = story
             
@@ -684,7 +2564,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logger.error(f"Story continuation error: {e}")
             await processing_msg.edit_text(
-                "حصل خطأ، جرب كمان مرة",
+                llm_error_text(e, "حصل خطأ، جرب كمان مرة"),
                 reply_markup=get_story_keyboard()
             )
     
@@ -696,51 +2576,32 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif query.data in ["game_iq", "game_riddles", "game_trivia"]:
         game_type = query.data.replace("game_", "")
-        game_prompts = {
-            "iq": "اسئلة ذكاء",
-            "riddles": "الغاز",
-            "trivia": "معلومات عامة"
-        }
-        
-        processing_msg = await query.edit_message_text("جاري تحضير السؤال... 🎯")
+        question = pop_game_question(game_type)
+        processing_msg = query.message
         
         try:
-            messages = [
-                {"role": "system", "content": "انت مقدم العاب ذكاء. اكتب سؤال مع 4 خيارات (أ، ب، ج، د) وحدد الجواب الصحيح في النهاية بصيغة: الجواب الصحيح: [الحرف]"},
-                {"role": "user", "content": f"اعطني سؤال {game_prompts.get(game_type, 'ذكاء')} صعب مع 4 خيارات بالعربي."}
-            ]
-            
-            response = groq_client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=messages,
-                max_tokens=500
-            )
+            if question is None:
+                game_stats["misses"] += 1
+                processing_msg = await query.edit_message_text("جاري تحضير السؤال... 🎯")
+                async with work_lanes["vip"].slot(processing_msg, "جاري تحضير السؤال... 🎯"):
+                    await wait_game_refill(game_type)
+                question = pop_game_question(game_type)
+                if question is None:
+                    raise ValueError(f"no valid {game_type} questions generated")
             
-            question = response.choices[0].message.content
-            question = clean_markdown(question)
-            
-            correct = "a"
-            if "الجواب الصحيح: أ" in question or "الجواب الصحيح: ا" in question:
-                correct = "a"
-            elif "الجواب الصحيح: ب" in question:
-                correct = "b"
-            elif "الجواب الصحيح: ج" in question:
-                correct = "c"
-            elif "الجواب الصحيح: د" in question:
-                correct = "d"
-            
-            display_question = re.sub(r'الجواب الصحيح:.*', '', question).strip()
+            game_stats["served"] += 1
+            await asyncio.to_thread(mark_game_served, question["id"])
+            display_question = format_game_question(question)
             context.user_data['current_question'] = display_question
-            context.user_data['correct_answer'] = correct
             
             await processing_msg.edit_text(
                 f"🎯 السؤال:\n\n{display_question}",
-                reply_markup=get_game_answer_keyboard(correct)
+                reply_markup=get_game_answer_keyboard(question["answer"], game_type)
             )
         except Exception as e:
             logger.error(f"Game error: {e}")
             await processing_msg.edit_text(
-                "حصل خطأ، جرب كمان مرة",
+                llm_error_text(e, "حصل خطأ، جرب كمان مرة"),
                 reply_markup=get_game_keyboard()
             )
     
@@ -748,21 +2609,22 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parts = query.data.split("_")
         user_answer = parts[2]
         correct_answer = parts[3]
+        game_type = parts[4] if len(parts) > 4 and parts[4] in GAME_TYPES else "trivia"
         
         if user_answer == correct_answer:
             await query.edit_message_text(
                 f"✅ اجابة صحيحة! ممتاز!\n\n{context.user_data.get('current_question', '')}",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("سؤال جديد 🔄", callback_data="game_trivia")],
+                    [InlineKeyboardButton("سؤال جديد 🔄", callback_data=f"game_{game_type}")],
                     [InlineKeyboardButton("رجوع 🔙", callback_data="vip_games")]
                 ])
             )
         else:
-            answer_map = {"a": "أ", "b": "ب", "c": "ج", "d": "د"}
+            answer_map = dict(zip(GAME_LETTERS, GAME_LETTERS_AR))
             await query.edit_message_text(
                 f"❌ اجابة خاطئة!\n\nالجواب الصحيح: {answer_map.get(correct_answer, correct_answer)}\n\n{context.user_data.get('current_question', '')}",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("سؤال جديد 🔄", callback_data="game_trivia")],
+                    [InlineKeyboardButton("سؤال جديد 🔄", callback_data=f"game_{game_type}")],
                     [InlineKeyboardButton("رجوع 🔙", callback_data="vip_games")]
                 ])
             )
@@ -777,7 +2639,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data == "pdf_details_yes":
         context.user_data['pdf_waiting_details'] = True
         await query.edit_message_text(
-            "📝 اكتبلي التفاصيل اللي بدك اياها:",
+            "📝 اكتبلي التفاصيل اللي بدك اياها:\n\nبتقدر تحدد صفحات معينة، مثلا: صفحات 3-5",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("الغاء ❌", callback_data="pdf_details_no")]])
         )
     
@@ -785,13 +2647,21 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['pdf_waiting_details'] = False
         pdf_data = context.user_data.get('pending_pdf')
         if pdf_data:
-            await process_pdf(update, context, pdf_data, None)
+            await start_solve(update, context, process_pdf, pdf_data, None)
         else:
             await query.edit_message_text(
                 "لم يتم العثور على ملف PDF",
                 reply_markup=get_main_keyboard()
             )
     
+    elif query.data == "pdf_cancel":
+        running = [task for task in solve_tasks.get(user.id, []) if task.get_name() == "process_pdf"]
+        if running:
+            for task in running:
+                task.cancel()
+        else:
+            await query.edit_message_reply_markup(reply_markup=None)
+    
     elif query.data == "rate_like":
         await query.answer("شكرا على تقييمك 💚", show_alert=True)
         await query.edit_message_reply_markup(reply_markup=None)
@@ -804,12 +2674,11 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if user.username != DEVELOPER_USERNAME:
             await query.answer("مش مسموحلك", show_alert=True)
             return
-        members = load_members()
+        total_members, total_questions = get_member_stats()
         banned = load_banned()
-        total_questions = sum(m.get("questions_count", 0) for m in members.values())
         stats_text = f"""احصائيات البوت:
 
-عدد المستخدمين: {len(members)}
+عدد المستخدمين: {total_members}
 عدد المحظورين: {len(banned)}
 عدد الاسئلة المحلولة: {total_questions}
 حالة البوت: {'شغال' if bot_active else 'واقف'}"""
@@ -907,115 +2776,411 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     add_member(user.id, user.username, user.first_name)
+    
+    photo = pick_photo_size(update.message.photo)
+    personality = get_user_personality(user.id)
+    cache_key = ("photo", photo.file_unique_id, personality, MODEL_ROUTES["vision"][0])
+    cached = answer_cache.get(cache_key)
+    if cached is not None:
+        await add_to_memory(user.id, "user", cached["question"])
+        await add_to_memory(user.id, "assistant", cached["answer"])
+        increment_questions(user.id)
+        await reply_answer(update.message, cached["answer"], get_rating_keyboard())
+        return
+    
+    await start_solve(update, context, solve_photo, photo, personality, cache_key)
+
+async def solve_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, photo, personality, cache_key):
+    user = update.effective_user
     processing_msg = await update.message.reply_text("عم بحل السؤال... 🔄")
     
     try:
-        photo = update.message.photo[-1]
-        file = await context.bot.get_file(photo.file_id)
-        
-        photo_bytes = BytesIO()
-        await file.download_to_memory(photo_bytes)
-        photo_bytes.seek(0)
-        
-        image_base64 = base64.b64encode(photo_bytes.read()).decode('utf-8')
-        
-        personality = get_user_personality(user.id)
-        personality_prompt = PERSONALITIES.get(personality, PERSONALITIES["teacher"])["prompt"]
-        
-        user_memory = get_user_memory(user.id)
-        messages = []
-        for mem in user_memory[-10:]:
-            messages.append(mem)
-        
+        async with work_lanes["vision"].slot(processing_msg, "عم بحل السؤال... 🔄"):
+            file = await context.bot.get_file(photo.file_id)
+            
+            image_data = await file.download_as_bytearray()
+            jpeg_data, image_hash = await preprocess_photo(image_data)
+            answer = find_similar_answer(image_hash, personality, MODEL_ROUTES["vision"][0])
+            
+            if answer is None:
+                image_base64 = base64.b64encode(jpeg_data).decode('ascii')
+                
+                personality_prompt = PERSONALITIES.get(personality, PERSONALITIES["teacher"])["prompt"]
+                
+                messages = await build_history(user.id, "vision")
+                messages.append({
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": f"{personality_prompt} حل هذا السؤال بالتفصيل وبطريقة سهلة الفهم. اكتب الاجابة بالعربي بدون اي تنسيق او نجوم او علامات. لو في اختيارات اختار الصح وقول ليه."},
+                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}
+                    ]
+                })
+                
+                answer = await stream_answer(context.bot, processing_msg, "vision", messages, 2000)
+                remember_photo_hash(image_hash, personality, MODEL_ROUTES["vision"][0], answer)
+            else:
+                await StreamingReply(context.bot, processing_msg).show(answer, get_rating_keyboard())
+            
+            answer_cache.set(cache_key, {"question": "سؤال بالصورة", "answer": answer})
+            
+            await add_to_memory(user.id, "user", "سؤال بالصورة")
+            await add_to_memory(user.id, "assistant", answer)
+            increment_questions(user.id)
+            
+    except asyncio.CancelledError:
+        await processing_msg.edit_text(SUPERSEDED_TEXT)
+        raise
+    except Exception as e:
+        logger.error(f"Error processing image: {e}")
+        await processing_msg.edit_text(llm_error_text(e, "صار في مشكلة بحل السؤال، جرب كمان مرة او ابعثلي صورة اوضح"))
+
+def pick_photo_size(photo_sizes):
+    # Telegram lists sizes smallest first; the smallest one that is still readable keeps the download short
+    for size in photo_sizes:
+        if min(size.width, size.height) >= PHOTO_MIN_SIDE:
+            return size
+    return photo_sizes[-1]
+
+def image_dhash(image):
+    # 256-bit difference hash over the whole frame
+    pixels = image.convert("L").resize((17, 16), Image.Resampling.BILINEAR).tobytes()
+    value = 0
+    for row in range(16):
+        for col in range(16):
+            value = (value << 1) | (pixels[row * 17 + col] > pixels[row * 17 + col + 1])
+    return value
+
+def trim_borders(image):
+    background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
+    bbox = ImageChops.difference(image, background).convert("L").point(lambda v: 255 if v > 24 else 0).getbbox()
+    if not bbox:
+        return image
+    margin = 12
+    bbox = (max(bbox[0] - margin, 0), max(bbox[1] - margin, 0), min(bbox[2] + margin, image.width), min(bbox[3] + margin, image.height))
+    if (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) < image.width * image.height * 0.9:
+        return image.crop(bbox)
+    return image
+
+def prepare_photo(image_data):
+    with Image.open(BytesIO(image_data)) as image:
+        is_jpeg = image.format == "JPEG"
+        # draft() shrinks the decoded size, so the passthrough check needs the original dimensions
+        original_side = max(image.size)
+        image.draft("RGB", (PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+        image = image.convert("RGB")
+    image_hash = image_dhash(image)
+    
+    if is_jpeg and len(image_data) <= PHOTO_TARGET_BYTES and original_side <= PHOTO_MAX_SIDE:
+        return image_data, image_hash
+    
+    image = trim_borders(image)
+    image.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE), Image.Resampling.LANCZOS)
+    while True:
+        for quality in (85, 75, 65):
+            output = BytesIO()
+            image.save(output, "JPEG", quality=quality, optimize=True)
+            if output.tell() <= PHOTO_TARGET_BYTES:
+                return output.getvalue(), image_hash
+        if max(image.size) <= PHOTO_MIN_SIDE:
+            return output.getvalue(), image_hash
+        image = image.resize((int(image.width * 0.8), int(image.height * 0.8)), Image.Resampling.LANCZOS)
+
+async def preprocess_photo(image_data):
+    try:
+        jpeg_data, image_hash = await asyncio.get_running_loop().run_in_executor(image_executor, prepare_photo, image_data)
+    except Exception as e:
+        # an image Pillow can't decode still goes to the model as sent, just without a hash
+        phash_stats["errors"] += 1
+        logger.error(f"Error preprocessing photo: {e}")
+        return bytes(image_data), None
+    image_stats["processed"] += 1
+    image_stats["bytes_in"] += len(image_data)
+    image_stats["bytes_out"] += len(jpeg_data)
+    return jpeg_data, image_hash
+
+def find_similar_answer(image_hash, personality, model):
+    if image_hash is None:
+        return None
+    now = time.monotonic()
+    best_distance = PHASH_MAX_DISTANCE + 1
+    best_answer = None
+    for entry_hash, entry_personality, entry_model, answer, expires in phash_index:
+        if entry_personality != personality or entry_model != model or expires < now:
+            continue
+        distance = (entry_hash ^ image_hash).bit_count()
+        if distance < best_distance:
+            best_distance, best_answer = distance, answer
+    phash_stats["hits" if best_answer is not None else "misses"] += 1
+    return best_answer
+
+def remember_photo_hash(image_hash, personality, model, answer):
+    if image_hash is not None:
+        phash_index.append((image_hash, personality, model, answer, time.monotonic() + ANSWER_CACHE_TTL))
+
+class PdfQueueFull(Exception):
+    pass
+
+def iter_pdf_pages(pdf_document, first_page, last_page):
+    for page_number in range(first_page, min(last_page, pdf_document.page_count)):
+        yield page_number, pdf_document[page_number].get_text()
+
+def extract_pdf_pages(pdf_bytes, first_page, last_page, char_budget, deadline):
+    pages = []
+    size = 0
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+        page_count = pdf_document.page_count
+        for page_number, page_text in iter_pdf_pages(pdf_document, first_page, last_page):
+            pages.append((page_number, page_text))
+            size += len(page_text)
+            if size >= char_budget or time.time() > deadline:
+                break
+    return page_count, pages
+
+def parse_page_range(details):
+    if not details:
+        return None
+    # prepositions attach to the word (بالصفحة، لصفحة، فصفحة), so they sit inside the word boundary
+    match = re.search(r'(?<!\w)(?:(?:[بف]?ال|لل|[بفل])?صفح\w*|pages?|ص)\s*(\d+)\s*(?:-|الى|إلى|لـ?|to)\s*(\d+)', details, re.IGNORECASE)
+    if match:
+        first, last = int(match.group(1)), int(match.group(2))
+        return max(first, 1) - 1, max(first, last)
+    match = re.search(r'(?<!\w)(?:(?:[بف]?ال|لل|[بفل])?صفح\w*|page|ص)\s*(\d+)', details, re.IGNORECASE)
+    if match:
+        page = max(int(match.group(1)), 1)
+        return page - 1, page
+    return None
+
+def init_pdf_pool():
+    global pdf_executor
+    # fork keeps the workers cheap on a 512MB instance; start them before any other thread exists
+    pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("fork"))
+    pdf_executor.submit(os.getpid).result()
+
+def restart_pdf_pool(broken):
+    global pdf_executor
+    # several jobs can hit the same dead pool; only the first one replaces it
+    if pdf_executor is not broken:
+        return
+    logger.error("PDF worker died, restarting the pool")
+    broken.shutdown(wait=False, cancel_futures=True)
+    # other threads are running by now and a fork could copy one of their held locks into the worker;
+    # forkserver forks the replacements from a clean single-threaded server instead
+    pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+    pdf_executor.submit(os.getpid)
+    pdf_stats["pool_restarts"] += 1
+
+async def run_pdf_worker(pdf_bytes, first_page, last_page, char_budget):
+    if pdf_stats["queued"] + pdf_stats["running"] >= PDF_MAX_JOBS:
+        pdf_stats["rejected"] += 1
+        raise PdfQueueFull()
+    
+    pdf_stats["queued"] += 1
+    waiting = True
+    try:
+        async with pdf_semaphore:
+            pdf_stats["queued"] -= 1
+            waiting = False
+            pdf_stats["running"] += 1
+            try:
+                # an OOM-killed worker breaks the whole pool; rebuild it and give the job one more try
+                for attempt in range(2):
+                    executor = pdf_executor
+                    try:
+                        future = asyncio.get_running_loop().run_in_executor(
+                            executor, extract_pdf_pages, pdf_bytes, first_page, last_page, char_budget, time.time() + PDF_TIMEOUT
+                        )
+                        result = await asyncio.wait_for(future, timeout=PDF_TIMEOUT + 10)
+                        break
+                    except BrokenProcessPool:
+                        restart_pdf_pool(executor)
+                        if attempt:
+                            raise
+            finally:
+                pdf_stats["running"] -= 1
+    except asyncio.TimeoutError:
+        pdf_stats["timeouts"] += 1
+        raise
+    except asyncio.CancelledError:
+        pdf_stats["cancelled"] += 1
+        raise
+    finally:
+        if waiting:
+            pdf_stats["queued"] -= 1
+    
+    pdf_stats["completed"] += 1
+    pdf_stats["pages_extracted"] += len(result[1])
+    return result
+
+async def extract_pdf(pdf_bytes, page_range=None, char_budget=PDF_MAX_CHARS):
+    digest = hashlib.sha1(pdf_bytes).hexdigest()
+    first_page, last_page = page_range or (0, PDF_MAX_PAGES)
+    last_page = min(last_page, first_page + PDF_MAX_PAGES)
+    page_count = pdf_page_cache.get((digest, "pages"))
+    if page_count is not None:
+        last_page = min(last_page, page_count)
+    
+    parts = []
+    size = 0
+    page_number = first_page
+    while page_number < last_page and size < char_budget:
+        page_text = pdf_page_cache.get((digest, page_number))
+        if page_text is None:
+            break
+        parts.append(page_text)
+        size += len(page_text)
+        page_number += 1
+    
+    if page_number < last_page and size < char_budget:
+        page_count, pages = await run_pdf_worker(pdf_bytes, page_number, last_page, char_budget - size)
+        pdf_page_cache.set((digest, "pages"), page_count)
+        for extracted_number, page_text in pages:
+            pdf_page_cache.set((digest, extracted_number), page_text)
+            parts.append(page_text)
+    
+    return "".join(parts)
+
+def build_pdf_prompt(personality_prompt, text, details, part=None):
+    prompt = f"{personality_prompt} حل الاسئلة في هذا النص بالتفصيل وبطريقة سهلة الفهم. اكتب الاجابة بالعربي بدون اي تنسيق او نجوم او علامات."
+    if part:
+        prompt += f"\n\nهذا الجزء {part[0]} من {part[1]} من الملف، حل الاسئلة الموجودة فيه فقط."
+    if details:
+        prompt += f"\n\nتفاصيل اضافية من المستخدم: {details}"
+    prompt += f"\n\nالنص:\n{text}"
+    return prompt
+
+def split_pdf_questions(text, chunk_chars):
+    # cut before numbered questions so a question and its choices stay in the same chunk
+    starts = [m.start() for m in re.finditer(r'^\s*(?:(?:السؤال|سؤال|Question|Q)\s*[\d٠-٩]+|[\d٠-٩]{1,3}\s*[.)\-])', text, re.MULTILINE | re.IGNORECASE)]
+    bounds = sorted(set([0] + starts + [len(text)]))
+    blocks = [text[a:b] for a, b in zip(bounds, bounds[1:]) if text[a:b].strip()]
+    
+    chunks = []
+    current = []
+    size = 0
+    for block in blocks:
+        while len(block) > chunk_chars:
+            cut = block.rfind("\n", 0, chunk_chars)
+            cut = cut if cut > chunk_chars // 2 else chunk_chars
+            piece, block = block[:cut], block[cut:]
+            if current:
+                chunks.append("".join(current))
+                current, size = [], 0
+            chunks.append(piece)
+        if size + len(block) > chunk_chars and current:
+            chunks.append("".join(current))
+            current, size = [], 0
+        current.append(block)
+        size += len(block)
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+async def solve_pdf_chunks(chunks, personality_prompt, details):
+    semaphore = asyncio.Semaphore(PDF_MAP_CONCURRENCY)
+    
+    async def solve_chunk(index, chunk):
+        async with semaphore:
+            messages = [{"role": "user", "content": build_pdf_prompt(personality_prompt, chunk, details, (index, len(chunks)))}]
+            answer = await llm_route("pdf", messages, 2000)
+            return clean_markdown(answer)
+    
+    results = await asyncio.gather(*(solve_chunk(i, chunk) for i, chunk in enumerate(chunks, 1)), return_exceptions=True)
+    for result in results:
+        if isinstance(result, asyncio.CancelledError):
+            raise result
+    if all(isinstance(result, Exception) for result in results):
+        raise results[0]
+    
+    sections = []
+    for i, result in enumerate(results, 1):
+        if isinstance(result, Exception):
+            logger.error(f"Error solving PDF chunk {i}/{len(chunks)}: {result}")
+            result = "ما قدرت احل هالجزء، ابعتلي صفحاته لحالها"
+        sections.append(f"الجزء {i}:\n{result}")
+    return "\n\n".join(sections)
+
+async def solve_pdf(context: ContextTypes.DEFAULT_TYPE, pdf_file, personality, details, user_id, processing_msg):
+    file = await context.bot.get_file(pdf_file["file_id"])
+    pdf_bytes = bytes(await file.download_as_bytearray())
+    text = await extract_pdf(pdf_bytes, parse_page_range(details), PDF_LARGE_MAX_CHARS)
+    
+    personality_prompt = PERSONALITIES.get(personality, PERSONALITIES["teacher"])["prompt"]
+    
+    if len(text) > PDF_MAX_CHARS:
+        if len(text) > PDF_LARGE_MAX_CHARS:
+            text = text[:PDF_LARGE_MAX_CHARS] + "..."
+        chunks = split_pdf_questions(text, PDF_CHUNK_CHARS)
+        await processing_msg.edit_text(
+            f"الملف كبير، عم بحل الاسئلة على {len(chunks)} اجزاء... 🔄",
+            reply_markup=get_pdf_cancel_keyboard()
+        )
+        answer = await solve_pdf_chunks(chunks, personality_prompt, details)
+    else:
+        messages = await build_history(user_id, "pdf")
         messages.append({
             "role": "user",
-            "content": [
-                {"type": "text", "text": f"{personality_prompt} حل هذا السؤال بالتفصيل وبطريقة سهلة الفهم. اكتب الاجابة بالعربي بدون اي تنسيق او نجوم او علامات. لو في اختيارات اختار الصح وقول ليه."},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}
-            ]
+            "content": build_pdf_prompt(personality_prompt, text, details)
         })
         
-        response = groq_client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=messages,
-            max_tokens=2000
+        answer = await stream_answer(
+            context.bot, processing_msg, "pdf", messages, 3000,
+            progress_markup=get_pdf_cancel_keyboard()
         )
-        
-        answer = response.choices[0].message.content
-        answer = clean_markdown(answer)
-        
-        add_to_memory(user.id, "user", "سؤال بالصورة")
-        add_to_memory(user.id, "assistant", answer)
-        increment_questions(user.id)
-        
-        await processing_msg.edit_text(f"الحل:\n\n{answer}", reply_markup=get_rating_keyboard())
-        
-    except Exception as e:
-        logger.error(f"Error processing image: {e}")
-        await processing_msg.edit_text("صار في مشكلة بحل السؤال، جرب كمان مرة او ابعثلي صورة اوضح")
+        return f"سؤال من PDF: {text[:200]}...", answer, True
+    
+    return f"سؤال من PDF: {text[:200]}...", answer, False
 
-async def process_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE, pdf_bytes, details):
+async def process_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE, pdf_file, details):
     user = update.effective_user if update.effective_user else update.callback_query.from_user
     
     chat_id = update.effective_chat.id
-    processing_msg = await context.bot.send_message(chat_id=chat_id, text="عم بقرأ الملف وبحل السؤال... 🔄")
+    processing_msg = await context.bot.send_message(
+        chat_id=chat_id,
+        text="عم بقرأ الملف وبحل السؤال... 🔄",
+        reply_markup=get_pdf_cancel_keyboard()
+    )
     
     try:
-        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-        text = ""
-        for page in pdf_document:
-            text += page.get_text()
-        pdf_document.close()
-        
-        if len(text) > 5000:
-            text = text[:5000] + "..."
-        
         personality = get_user_personality(user.id)
-        personality_prompt = PERSONALITIES.get(personality, PERSONALITIES["teacher"])["prompt"]
-        
-        user_memory = get_user_memory(user.id)
-        messages = []
-        for mem in user_memory[-10:]:
-            messages.append(mem)
-        
-        prompt = f"{personality_prompt} حل الاسئلة في هذا النص بالتفصيل وبطريقة سهلة الفهم. اكتب الاجابة بالعربي بدون اي تنسيق او نجوم او علامات."
-        if details:
-            prompt += f"\n\nتفاصيل اضافية من المستخدم: {details}"
-        prompt += f"\n\nالنص:\n{text}"
-        
-        messages.append({
-            "role": "user",
-            "content": prompt
-        })
-        
-        response = groq_client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=messages,
-            max_tokens=3000
-        )
-        
-        answer = response.choices[0].message.content
-        answer = clean_markdown(answer)
+        cache_key = ("pdf", pdf_file["file_unique_id"], personality, MODEL_ROUTES["pdf"][0], details or "")
+        cached = answer_cache.get(cache_key)
+        if cached is not None:
+            question, answer, delivered = cached["question"], cached["answer"], False
+        else:
+            async with work_lanes["pdf"].slot(processing_msg, "عم بقرأ الملف وبحل السؤال... 🔄", get_pdf_cancel_keyboard()):
+                question, answer, delivered = await solve_pdf(context, pdf_file, personality, details, user.id, processing_msg)
+            answer_cache.set(cache_key, {"question": question, "answer": answer})
         
-        add_to_memory(user.id, "user", f"سؤال من PDF: {text[:200]}...")
-        add_to_memory(user.id, "assistant", answer)
+        await add_to_memory(user.id, "user", question)
+        await add_to_memory(user.id, "assistant", answer)
         increment_questions(user.id)
         
-        if len(answer) > 4000:
-            parts = [answer[i:i+4000] for i in range(0, len(answer), 4000)]
-            await processing_msg.edit_text(f"الحل (جزء 1):\n\n{parts[0]}")
-            for i, part in enumerate(parts[1:], 2):
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"الحل (جزء {i}):\n\n{part}",
-                    reply_markup=get_rating_keyboard() if i == len(parts) else None
-                )
-        else:
-            await processing_msg.edit_text(f"الحل:\n\n{answer}", reply_markup=get_rating_keyboard())
+        if not delivered:
+            if len(answer) > 4000:
+                parts = [answer[i:i+4000] for i in range(0, len(answer), 4000)]
+                await processing_msg.edit_text(f"الحل (جزء 1):\n\n{parts[0]}")
+                for i, part in enumerate(parts[1:], 2):
+                    await context.bot.send_message(
+                        chat_id=chat_id,
+                        text=f"الحل (جزء {i}):\n\n{part}",
+                        reply_markup=get_rating_keyboard() if i == len(parts) else None
+                    )
+            else:
+                await processing_msg.edit_text(f"الحل:\n\n{answer}", reply_markup=get_rating_keyboard())
         
         context.user_data['pending_pdf'] = None
         context.user_data['pdf_waiting_details'] = False
         
+    except asyncio.CancelledError:
+        await processing_msg.edit_text("تم الغاء حل الملف ❌")
+        raise
+    except PdfQueueFull:
+        await processing_msg.edit_text("في ضغط كبير على قراءة الملفات هلق، جرب بعد شوي")
+    except (LLMUnavailable, RateLimitError) as e:
+        await processing_msg.edit_text(llm_error_text(e, ""))
+    except asyncio.TimeoutError:
+        logger.error(f"PDF processing timed out for {user.id}")
+        await processing_msg.edit_text("الملف اخد وقت كتير، جرب ملف اصغر او ابعت الصفحات المهمة بس")
     except Exception as e:
         logger.error(f"Error processing PDF: {e}")
         await processing_msg.edit_text("صار في مشكلة بقراءة الملف، جرب كمان مرة")
@@ -1050,13 +3215,8 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     add_member(user.id, user.username, user.first_name)
     
-    file = await context.bot.get_file(document.file_id)
-    pdf_bytes = BytesIO()
-    await file.download_to_memory(pdf_bytes)
-    pdf_bytes.seek(0)
-    pdf_data = pdf_bytes.read()
-    
-    context.user_data['pending_pdf'] = pdf_data
+    # download lazily in process_pdf so a cached answer never touches the file
+    context.user_data['pending_pdf'] = {"file_id": document.file_id, "file_unique_id": document.file_unique_id}
     
     await update.message.reply_text(
         "📄 هل تريد كتابة تفاصيل معينة؟",
@@ -1083,17 +3243,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user.username == DEVELOPER_USERNAME:
         if context.user_data.get('waiting_broadcast'):
             context.user_data['waiting_broadcast'] = False
-            members = load_members()
-            success = 0
-            fail = 0
-            status_msg = await update.message.reply_text("جاري الاذاعة...")
-            for user_id in members.keys():
-                try:
-                    await context.bot.send_message(chat_id=int(user_id), text=text)
-                    success += 1
-                except:
-                    fail += 1
-            await status_msg.edit_text(f"تم الاذاعة\n\nنجح: {success}\nفشل: {fail}")
+            await start_broadcast(update, context, text)
             return
         
         if context.user_data.get('waiting_ban'):
@@ -1120,14 +3270,14 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['pdf_waiting_details'] = False
         pdf_data = context.user_data.get('pending_pdf')
         if pdf_data:
-            await process_pdf(update, context, pdf_data, text)
+            await start_solve(update, context, process_pdf, pdf_data, text)
         return
     
     mode = context.user_data.get('mode')
     
     if mode == 'translate':
         try:
-            detected_lang = detect(text)
+            detected_lang = detect_language(text)
             detected_msg = await update.message.reply_text(f"حسنا تم التعرف التلقائي على اللغة ✅")
             await asyncio.sleep(2)
             await detected_msg.delete()
@@ -1135,6 +3285,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
         
         context.user_data['text_to_translate'] = text
+        context.user_data['translate_targets'] = None
         await update.message.reply_text(
             "🌍 قم باختيار لغة الترجمة:",
             reply_markup=get_language_keyboard()
@@ -1142,27 +3293,46 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if mode == 'tts':
+        if len(text) > TTS_MAX_CHARS:
+            await update.message.reply_text(f"النص طويل كتير، الحد الاقصى {TTS_MAX_CHARS} حرف")
+            return
+        
         processing_msg = await update.message.reply_text("جاري تحويل النص لصوت... 🔊")
         
         try:
-            try:
-                lang = detect(text)
-                if lang not in ['ar', 'en', 'fr', 'es', 'de', 'it', 'ru', 'pt', 'tr', 'hi', 'ja', 'ko', 'zh-cn']:
-                    lang = 'ar'
-            except:
+            lang = detect_language(text)
+            if lang not in TTS_LANGS:
                 lang = 'ar'
             
-            tts = gTTS(text=text, lang=lang)
-            audio_bytes = BytesIO()
-            tts.write_to_fp(audio_bytes)
-            audio_bytes.seek(0)
+            # a repeat request costs one send_voice with the file_id Telegram gave us the first time
+            text_hash = hashlib.sha1(" ".join(text.split()).encode("utf-8")).hexdigest()
+            file_id = await asyncio.to_thread(load_tts_file_id, text_hash, lang)
+            if file_id is not None:
+                try:
+                    await update.message.reply_voice(
+                        voice=file_id,
+                        caption="🔊 تم تحويل النص لصوت",
+                        reply_markup=get_vip_keyboard()
+                    )
+                    tts_stats["cache_hits"] += 1
+                    await processing_msg.delete()
+                    context.user_data['mode'] = None
+                    return
+                except BadRequest as e:
+                    tts_stats["stale_file_ids"] += 1
+                    logger.warning(f"Cached TTS file_id rejected, synthesizing again: {e}")
+            
+            async with work_lanes["vip"].slot(processing_msg, "جاري تحويل النص لصوت... 🔊"):
+                audio = await asyncio.wait_for(synthesize_speech(text, lang), TTS_TIMEOUT)
             
             await processing_msg.delete()
-            await update.message.reply_voice(
-                voice=audio_bytes,
+            voice_msg = await update.message.reply_voice(
+                voice=audio,
                 caption="🔊 تم تحويل النص لصوت",
                 reply_markup=get_vip_keyboard()
             )
+            if voice_msg.voice:
+                await asyncio.to_thread(save_tts_file_id, text_hash, lang, voice_msg.voice.file_id)
             context.user_data['mode'] = None
         except Exception as e:
             logger.error(f"TTS error: {e}")
@@ -1185,43 +3355,38 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if mode == 'text' or len(text) > 10:
         add_member(user.id, user.username, user.first_name)
-        processing_msg = await update.message.reply_text("عم بحل السؤال... 🔄")
-        
-        try:
+        await start_solve(update, context, solve_text, text)
+    else:
+        await update.message.reply_text(
+            "ابعتلي صورة السؤال او اكتبلي السؤال عشان احله",
+            reply_markup=get_main_keyboard()
+        )
+
+async def solve_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text):
+    user = update.effective_user
+    processing_msg = await update.message.reply_text("عم بحل السؤال... 🔄")
+    
+    try:
+        async with work_lanes["text"].slot(processing_msg, "عم بحل السؤال... 🔄"):
             personality = get_user_personality(user.id)
             personality_prompt = PERSONALITIES.get(personality, PERSONALITIES["teacher"])["prompt"]
             
-            user_memory = get_user_memory(user.id)
             messages = [{"role": "system", "content": f"{personality_prompt} اجب بالعربي بشكل واضح ومفصل بدون اي تنسيق او نجوم او علامات markdown."}]
-            
-            for mem in user_memory[-10:]:
-                messages.append(mem)
-            
+            messages.extend(await build_history(user.id, "text"))
             messages.append({"role": "user", "content": text})
             
-            response = groq_client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=messages,
-                max_tokens=2000
-            )
-            
-            answer = response.choices[0].message.content
-            answer = clean_markdown(answer)
+            answer = await stream_answer(context.bot, processing_msg, "text", messages, 2000)
             
-            add_to_memory(user.id, "user", text)
-            add_to_memory(user.id, "assistant", answer)
+            await add_to_memory(user.id, "user", text)
+            await add_to_memory(user.id, "assistant", answer)
             increment_questions(user.id)
             
-            await processing_msg.edit_text(f"الحل:\n\n{answer}", reply_markup=get_rating_keyboard())
-            
-        except Exception as e:
-            logger.error(f"Error processing text: {e}")
-            await processing_msg.edit_text("صار في مشكلة، جرب كمان مرة")
-    else:
-        await update.message.reply_text(
-            "ابعتلي صورة السؤال او اكتبلي السؤال عشان احله",
-            reply_markup=get_main_keyboard()
-        )
+    except asyncio.CancelledError:
+        await processing_msg.edit_text(SUPERSEDED_TEXT)
+        raise
+    except Exception as e:
+        logger.error(f"Error processing text: {e}")
+        await processing_msg.edit_text(llm_error_text(e, "صار في مشكلة، جرب كمان مرة"))
 
 async def handle_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.inline_query.query
@@ -1257,10 +3422,33 @@ async def handle_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.inline_query.answer(results, cache_time=60)
 
 async def health_check(request):
-    return web.Response(text="OK", status=200)
+    breakers = {model: breaker.stats() for model, breaker in llm_breakers.items()}
+    status = "degraded" if any(b["state"] != "closed" for b in breakers.values()) else "ok"
+    return web.json_response({"status": status, "llm": breakers})
+
+async def metrics_handler(request):
+    return web.json_response(collect_metrics())
+
+def cancel_background_work():
+    # app.stop() waits for solves and jobs; cancel them instead so shutdown fits in the grace period
+    tasks = [task for tasks in solve_tasks.values() for task in tasks]
+    tasks += list(broadcast_tasks) + list(horoscope_tasks.values()) + list(game_refills.values()) + list(summary_tasks.values())
+    tasks = [task for task in tasks if not task.done()]
+    for task in tasks:
+        task.cancel()
+    return tasks
 
 async def run_bot():
-    app = Application.builder().token(BOT_TOKEN).build()
+    init_pdf_pool()
+    init_db()
+    init_llm()
+    await asyncio.to_thread(warm_language_detector)
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .build()
+    )
     
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("VipFree", vipfree_command))
@@ -1270,10 +3458,19 @@ async def run_bot():
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, handle_text))
     app.add_handler(CallbackQueryHandler(handle_callback))
     app.add_handler(InlineQueryHandler(handle_inline))
+    app.add_handler(ChatMemberHandler(handle_channel_member, ChatMemberHandler.CHAT_MEMBER))
+    app.job_queue.run_repeating(flush_state_job, interval=STATE_FLUSH_INTERVAL, first=STATE_FLUSH_INTERVAL)
+    app.job_queue.run_repeating(reload_banned_job, interval=BANNED_RELOAD_INTERVAL, first=0)
+    hour, minute = map(int, HOROSCOPE_PREGEN_TIME.split(":"))
+    pregen_time = datetime.now().astimezone().replace(hour=hour, minute=minute, second=0, microsecond=0).timetz()
+    app.job_queue.run_daily(pregenerate_horoscopes, time=pregen_time)
+    app.job_queue.run_once(pregenerate_horoscopes, when=5)
+    app.job_queue.run_once(fill_game_pools, when=10)
     
     web_app = web.Application()
     web_app.router.add_get('/', health_check)
     web_app.router.add_get('/health', health_check)
+    web_app.router.add_get('/metrics', metrics_handler)
     
     runner = web.AppRunner(web_app)
     await runner.setup()
@@ -1285,11 +3482,38 @@ async def run_bot():
     
     await app.initialize()
     await app.start()
-    await app.updater.start_polling(drop_pending_updates=True)
+    await app.updater.start_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
     logger.info("Bot started polling...")
     
-    while True:
-        await asyncio.sleep(3600)
+    for broadcast in load_running_broadcasts():
+        logger.info(f"Resuming broadcast {broadcast['id']} after user {broadcast['cursor']}")
+        spawn_broadcast(app.bot, broadcast)
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Shutting down, flushing state...")
+        # flush before anything that can wait on the LLM, the platform kills us after its grace period
+        await flush_state()
+        tasks = cancel_background_work()
+        if tasks:
+            await asyncio.wait(tasks, timeout=SHUTDOWN_TASK_TIMEOUT)
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+        await runner.cleanup()
+        await close_llm()
+        image_executor.shutdown(wait=False, cancel_futures=True)
+        tts_executor.shutdown(wait=False, cancel_futures=True)
+        pdf_executor.shutdown(wait=False, cancel_futures=True)
+        await flush_state()
+        db.close()
+        logger.info(f"State flushed: {state_stats}")
 
 if __name__ == "__main__":
     asyncio.run(run_bot())